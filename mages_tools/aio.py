@@ -0,0 +1,57 @@
+from typing import Callable, Optional, TypeVar
+from concurrent.futures import Executor, ThreadPoolExecutor
+import asyncio
+import weakref
+
+T = TypeVar('T')
+
+DEFAULT_CONCURRENCY = 8
+
+class AsyncRunner:
+    # 把阻塞的文件操作放到线程池中执行，并用信号量限制同时进行的数量
+    concurrency: int
+    _executor: Optional[Executor]
+    _own_executor: bool
+    _semaphores: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]'
+
+    def __init__(self, concurrency: int = DEFAULT_CONCURRENCY, executor: Optional[Executor] = None):
+        if concurrency < 1: raise ValueError('invalid concurrency')
+        self.concurrency = concurrency
+        self._executor = executor
+        self._own_executor = executor is None
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.concurrency, thread_name_prefix='mages_tools')
+        return self._executor
+
+    @property
+    def semaphore(self):
+        # 信号量会绑定到第一次等待它的事件循环，因此每个事件循环各用一个，循环结束后自动丢弃
+        # 各事件循环分别限制并发数，线程池仍是共用的
+        loop = asyncio.get_running_loop()
+        if (semaphore := self._semaphores.get(loop)) is None:
+            semaphore = self._semaphores.setdefault(loop, asyncio.Semaphore(self.concurrency))
+        return semaphore
+
+    async def run(self, func: Callable[..., T], *args, on_cancel: Optional[Callable[[], object]] = None) -> T:
+        async with self.semaphore:
+            cfuture = self.executor.submit(func, *args)
+            future = asyncio.wrap_future(cfuture)
+            try: return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # 已经开始的调用无法中断，通知它尽早结束并等待，保证调用方随后可以安全地关闭文件
+                if not cfuture.cancel():
+                    if on_cancel is not None: on_cancel()
+                    await asyncio.wait([future])
+                    if not future.cancelled(): future.exception() # 结果已无人关心
+                raise
+
+    def close(self):
+        if self._own_executor and self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+DEFAULT_RUNNER = AsyncRunner()
@@ -0,0 +1,114 @@
+from typing import Callable
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from io import BytesIO
+import time
+import tracemalloc
+import tempfile
+import platform
+import sys
+from mages_tools.io import *
+from mages_tools.mpk.layout import MPKLayout
+from mages_tools.scx.layout import SCXLayout
+from mages_tools.scx.codec import DEFAULT_CODEC
+from mages_tools.scx.tokenizer import tokenize_from_buffer, untokenize_to_buffer, tokenize_many, untokenize_many
+from .corpus import MPKParams, SCXParams, make_mpk, make_scx, make_token_lists
+
+@dataclass(slots=True)
+class BenchResult:
+    seconds: float # 多次运行中最快的一次
+    bytes: int # 每次处理的数据量
+    items: int # 每次处理的条目数（记录、字符串等）
+    peak_bytes: int | None # tracemalloc统计的峰值内存，未统计时为None
+
+    @property
+    def mb_per_s(self): return self.bytes / self.seconds / 1e6 if self.seconds else 0.0
+
+    @property
+    def items_per_s(self): return self.items / self.seconds if self.seconds else 0.0
+
+    def to_json(self):
+        return asdict(self) | {'mb_per_s': self.mb_per_s, 'items_per_s': self.items_per_s}
+
+def measure(func: Callable[[], object], nbytes: int, nitems: int, repeat: int = 3, memory: bool = True):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    peak = None
+    if memory:
+        # 单独运行一次统计内存，避免tracemalloc影响计时
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally: tracemalloc.stop()
+    return BenchResult(best, nbytes, nitems, peak)
+
+def dump_to_bytes(layout: MPKLayout | SCXLayout):
+    buf = BytesIO()
+    with BufferedWriter(buf) as data: layout.dump(data)
+    return buf.getvalue()
+
+def run_suite(mpk_params: MPKParams, scx_params: SCXParams, repeat: int = 3, memory: bool = True):
+    results = dict[str, BenchResult]()
+    def bench(name: str, func: Callable[[], object], nbytes: int, nitems: int):
+        results[name] = measure(func, nbytes, nitems, repeat, memory)
+
+    # MPK
+    mpk = make_mpk(mpk_params)
+    mpk_raw = dump_to_bytes(mpk)
+    count = len(mpk.entries)
+    bench('mpk.load_table', lambda: MPKLayout.load_table(ViewBuffer(mpk_raw)), MPKLayout.ENTRY_SIZE * count, count)
+    bench('mpk.load', lambda: MPKLayout.load(ViewBuffer(mpk_raw)), len(mpk_raw), count)
+    bench('mpk.dump', lambda: dump_to_bytes(mpk), len(mpk_raw), count)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'bench.mpk'
+        bench('mpk.write', lambda: mpk.write(path), len(mpk_raw), count)
+        bench('mpk.read', lambda: MPKLayout.read(path), len(mpk_raw), count)
+    del mpk
+
+    # SCX
+    scx = make_scx(scx_params)
+    scx_raw = dump_to_bytes(scx)
+    strings = scx.strings_raw
+    nstr = len(strings)
+    strings_size = sum(map(len, strings))
+    bench('scx.load', lambda: SCXLayout.load(ViewBuffer(scx_raw)), len(scx_raw), nstr)
+    bench('scx.dump', lambda: dump_to_bytes(scx), len(scx_raw), nstr)
+    bench('scx.tokenize', lambda: [list(tokenize_from_buffer(strn)) for strn in strings], strings_size, nstr)
+    bench('scx.tokenize_many', lambda: tokenize_many(strings), strings_size, nstr)
+    token_lists = make_token_lists(scx_params)
+    bench('scx.untokenize', lambda: [untokenize_to_buffer(tokens) for tokens in token_lists], strings_size, nstr)
+    bench('scx.untokenize_many', lambda: untokenize_many(token_lists), strings_size, nstr)
+
+    # 编解码
+    texts = [token for tokens in token_lists for token in tokens if isinstance(token, str)]
+    units = DEFAULT_CODEC.encode_many(texts)
+    units_size = 2 * sum(map(len, units))
+    bench('codec.decode', lambda: [DEFAULT_CODEC.decode(text_units) for text_units in units], units_size, len(units))
+    bench('codec.decode_many', lambda: DEFAULT_CODEC.decode_many(units), units_size, len(units))
+    bench('codec.encode', lambda: [DEFAULT_CODEC.encode(text) for text in texts], units_size, len(texts))
+    bench('codec.encode_many', lambda: DEFAULT_CODEC.encode_many(texts), units_size, len(texts))
+    return results
+
+def report(results: dict[str, BenchResult], mpk_params: MPKParams, scx_params: SCXParams):
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': sys.version,
+            'platform': platform.platform(),
+        },
+        'params': {'mpk': asdict(mpk_params), 'scx': asdict(scx_params)},
+        'results': {name: result.to_json() for name, result in results.items()},
+    }
+
+def compare(old: dict, new: dict, threshold: float = 0.1):
+    # 返回(名称, 旧耗时, 新耗时, 新/旧, 是否退化)，只比较两边都有的项目
+    rows = list[tuple[str, float, float, float, bool]]()
+    for name, new_result in new['results'].items():
+        if (old_result := old['results'].get(name)) is None: continue
+        ratio = new_result['seconds'] / old_result['seconds'] if old_result['seconds'] else float('inf')
+        rows.append((name, old_result['seconds'], new_result['seconds'], ratio, ratio > 1 + threshold))
+    return rows
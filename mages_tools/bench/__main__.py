@@ -0,0 +1,50 @@
+from pathlib import Path
+from typing import Optional
+import json
+from mages_tools.bench import run_suite, report, compare
+from mages_tools.bench.corpus import MPKParams, SCXParams
+
+import click
+
+DEFAULT_MPK = MPKParams()
+DEFAULT_SCX = SCXParams()
+
+@click.group()
+def cli():
+    pass
+
+@cli.command()
+@click.option('--out', '-o', default=None, help='write results as JSON to this file')
+@click.option('--entries', type=click.IntRange(min=1), default=DEFAULT_MPK.entries, help='MPK entry count')
+@click.option('--max-size', type=click.IntRange(min=0), default=DEFAULT_MPK.max_size, help='maximum MPK entry size')
+@click.option('--strings', type=click.IntRange(min=1), default=DEFAULT_SCX.strings, help='SCX string count')
+@click.option('--max-tokens', type=click.IntRange(min=1), default=DEFAULT_SCX.max_tokens, help='maximum tokens per string')
+@click.option('--seed', type=int, default=0)
+@click.option('--repeat', type=click.IntRange(min=1), default=3)
+@click.option('--no-memory', is_flag=True, help='skip peak memory measurement')
+def run(out: Optional[str], entries: int, max_size: int, strings: int, max_tokens: int, seed: int, repeat: int, no_memory: bool):
+    mpk_params = MPKParams(entries=entries, max_size=max_size, seed=seed)
+    scx_params = SCXParams(strings=strings, max_tokens=max_tokens, seed=seed)
+    results = run_suite(mpk_params, scx_params, repeat, not no_memory)
+    for name, result in results.items():
+        peak = '' if result.peak_bytes is None else f'{result.peak_bytes / 1e6:10.2f} MB peak'
+        click.echo(f'{name:22} {result.seconds * 1e3:10.2f} ms {result.mb_per_s:10.2f} MB/s {result.items_per_s:12.0f} items/s {peak}')
+    if out is not None:
+        Path(out).write_text(json.dumps(report(results, mpk_params, scx_params), indent=1), encoding='utf-8')
+
+@cli.command('compare')
+@click.argument('old')
+@click.argument('new')
+@click.option('--threshold', type=float, default=0.1, help='relative slowdown reported as regression')
+def compare_cmd(old: str, new: str, threshold: float):
+    rows = compare(
+        json.loads(Path(old).read_text(encoding='utf-8')),
+        json.loads(Path(new).read_text(encoding='utf-8')),
+        threshold,
+    )
+    for name, old_seconds, new_seconds, ratio, regressed in rows:
+        mark = '  REGRESSION' if regressed else ''
+        click.echo(f'{name:22} {old_seconds * 1e3:10.2f} ms -> {new_seconds * 1e3:10.2f} ms  x{ratio:.2f}{mark}')
+    if any(row[4] for row in rows): raise SystemExit(1)
+
+cli()
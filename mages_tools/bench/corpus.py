@@ -0,0 +1,78 @@
+from array import array
+from dataclasses import dataclass, field
+import random
+from mages_tools.mpk.layout import MPKLayout
+from mages_tools.scx.layout import SCXLayout
+from mages_tools.scx.codec import SCXCodec, DEFAULT_CODEC
+from mages_tools.scx.tokenizer import TokenType, SCXToken, BareToken, UnaryToken, ExpressionToken, registry, untokenize_many
+
+# 生成确定性的合成MPK/SCX数据，相同的参数与种子总是得到相同的结果
+
+@dataclass(slots=True)
+class MPKParams:
+    entries: int = 1000
+    min_size: int = 0
+    max_size: int = 64 * 1024
+    seed: int = 0
+
+@dataclass(slots=True)
+class SCXParams:
+    strings: int = 2000
+    min_tokens: int = 1
+    max_tokens: int = 24
+    max_text: int = 40 # 每段文本的最大字符数
+    # 各类词法单元的权重
+    token_mix: dict[str, float] = field(default_factory=lambda: {'text': 6, 'bare': 3, 'unary': 1, 'expression': 1})
+    code_size: int = 64 * 1024
+    seed: int = 0
+
+def make_mpk(params: MPKParams):
+    rng = random.Random(params.seed)
+    entries = dict[bytes, bytes]()
+    for idx in range(params.entries):
+        entries[f'entry{idx:06d}.bin'.encode()] = rng.randbytes(rng.randint(params.min_size, params.max_size))
+    return MPKLayout(entries=entries)
+
+def random_token(rng: random.Random, kind: str, chars: str, max_text: int) -> str | SCXToken:
+    if kind == 'text':
+        return ''.join(rng.choices(chars, k=rng.randint(1, max_text)))
+    types = [typ for typ, cls in registry.items() if cls is {'bare': BareToken, 'unary': UnaryToken, 'expression': ExpressionToken}[kind]]
+    typ = rng.choice(types)
+    if kind == 'bare': return BareToken(typ)
+    if kind == 'unary': return UnaryToken(typ, rng.randint(-0x8000, 0x7FFF))
+    args = list[tuple[int, bytes]]()
+    for _ in range(rng.randint(0, 3)):
+        ctrl = rng.randint(1, 0xFF)
+        args.append((ctrl, rng.randbytes((ctrl & 0b01100000) >> 5)))
+    return ExpressionToken(typ, args)
+
+def make_token_lists(params: SCXParams, codec: SCXCodec = DEFAULT_CODEC):
+    rng = random.Random(params.seed)
+    chars = ''.join(map(chr, sorted(set(codec.charset.values()))))
+    kinds = list(params.token_mix)
+    weights = [params.token_mix[kind] for kind in kinds]
+    token_lists = list[list[str | SCXToken]]()
+    for _ in range(params.strings):
+        tokens = list[str | SCXToken]()
+        for kind in rng.choices(kinds, weights, k=rng.randint(params.min_tokens, params.max_tokens)):
+            token = random_token(rng, kind, chars, params.max_text)
+            if isinstance(token, str):
+                # 相邻的文本在分词时会合并，这里预先合并以便比较
+                if tokens and isinstance(tokens[-1], str):
+                    tokens[-1] += token; continue
+            tokens.append(token)
+        token_lists.append(tokens)
+    return token_lists
+
+def make_scx(params: SCXParams, codec: SCXCodec = DEFAULT_CODEC):
+    rng = random.Random(params.seed + 1)
+    strings = [strn + bytes([TokenType.Termination]) for strn in untokenize_many(make_token_lists(params, codec), codec)]
+    labels = array('I', [0] * 16)
+    labels[0] = 4 + 4 * 2 + 4 * len(labels) # 第一项即标签表末尾
+    return SCXLayout(
+        entry_label=labels[0],
+        labels=labels,
+        codes_raw=rng.randbytes(params.code_size),
+        return_addrs=array('I', (rng.getrandbits(32) for _ in range(16))),
+        strings_raw=strings,
+    )
@@ -1,3 +1,18 @@
 class InvalidDataError(Exception): pass
 
 class InformalDataWarning(UserWarning): pass
+
+class UnmappedCharacterError(InvalidDataError, KeyError):
+    # 为了兼容原先直接抛出KeyError的行为，同时继承KeyError
+    unmapped: list[tuple[int, int]] # (位置, 字符码)
+    item: int | None # 批量处理时出错的条目序号
+
+    def __init__(self, unmapped: list[tuple[int, int]], item: int | None = None):
+        super().__init__(unmapped, item)
+        self.unmapped = unmapped
+        self.item = item
+
+    def __str__(self):
+        chars = ', '.join(f'{hex(val)} at {pos}' for pos, val in self.unmapped)
+        if self.item is None: return f'unmapped characters: {chars}'
+        return f'unmapped characters in item {self.item}: {chars}'
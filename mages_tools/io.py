@@ -1,6 +1,13 @@
 from abc import ABC, abstractmethod
-from typing import BinaryIO, ByteString
-from io import SEEK_END
+from typing import BinaryIO, ByteString, Optional, Iterable
+from io import SEEK_END, SEEK_CUR
+from pathlib import Path
+import os
+import re
+import mmap
+import struct
+import threading
+from mages_tools import stats
 
 __all__ = [
     'Sequencial',
@@ -11,7 +18,16 @@ __all__ = [
     'RandomWritable',
     'RandomAccessible',
     'ROBuffer',
+    'ViewBuffer',
+    'MMapReader',
     'FileWrapper',
+    'BufferedWriter',
+    'copy_stream',
+    'copy_range',
+    'pread',
+    'pwrite',
+    'writev',
+    'preallocate',
 ]
 
 class Sequencial(ABC):
@@ -63,6 +79,7 @@ class Readable(Sequencial):
     def read_zstr(self):
         result = bytearray()
         while (ch := self.read(1)) != b'\0':
+            if not ch: raise EOFError('unterminated string')
             result.extend(ch)
         return bytes(result)
 
@@ -98,8 +115,8 @@ class Writable(Sequencial):
         self.write((val + 0x8000).to_bytes(2, byteorder='big', signed=False))
 
     def pad(self, size: int, pattern: ByteString = b'\0'):
-        for i in range(size // len(pattern)): self.write(pattern)
-        self.write(pattern[:size % len(pattern)])
+        if size <= 0: return
+        self.write(bytes(pattern) * (size // len(pattern)) + pattern[:size % len(pattern)])
 
     def pad_until(self, pos: int, pattern: ByteString = b'\0'):
         self.pad(pos - self.tell(), pattern)
@@ -107,12 +124,36 @@ class Writable(Sequencial):
     def write_zstr(self, val: ByteString):
         self.write(val); self.write(b'\0')
 
+    def write_from(self, src: BinaryIO, size: int, src_offset: Optional[int] = None):
+        # 从文件中复制数据写入，子类可以改用内核态复制
+        if src_offset is not None: src.seek(src_offset)
+        while size > 0:
+            chunk = src.read(min(COPY_CHUNK_SIZE, size))
+            if not chunk: raise EOFError('source ended before all data was copied')
+            self.write(chunk)
+            size -= len(chunk)
+
+    def writev(self, buffers: Iterable[ByteString]):
+        # 依次写出多段数据，支持时合并为一次系统调用
+        for buf in buffers: self.write(buf)
+
 class RandomReadable(Seekable, Readable): pass
 
 class RandomWritable(Seekable, Writable): pass
 
 class RandomAccessible(Seekable, Readable, Writable): pass
 
+U8 = struct.Struct('<B'); I8 = struct.Struct('<b')
+U16 = struct.Struct('<H'); I16 = struct.Struct('<h')
+U32 = struct.Struct('<I'); I32 = struct.Struct('<i')
+U64 = struct.Struct('<Q'); I64 = struct.Struct('<q')
+CHARCODE = struct.Struct('>H')
+ZERO_BYTE = re.compile(b'\0')
+ZSTR_CHUNK_SIZE = 256
+WRITE_BUFFER_SIZE = 1 << 20
+HOLE_MIN_SIZE = 1 << 16 # 至少这么大的补0才留成空洞
+WRITEV_MIN_SIZE = 1 << 12 # 至少这么大的数据段才单独作为iovec
+
 class ROBuffer(RandomReadable):
     buf: ByteString; pos: int
 
@@ -129,23 +170,380 @@ class ROBuffer(RandomReadable):
 
     def size(self): return len(self.buf)
 
+    # 以下直接从缓冲区解码，不经过切片；越界时沿用Readable的行为
+    def _unpack(self, fmt: struct.Struct, fallback):
+        pos = self.pos
+        if pos + fmt.size > len(self.buf): return fallback(self)
+        self.pos = pos + fmt.size
+        return fmt.unpack_from(self.buf, pos)[0]
+
+    def read_u8(self): return self._unpack(U8, Readable.read_u8)
+
+    def read_i8(self): return self._unpack(I8, Readable.read_i8)
+
+    def read_u16(self): return self._unpack(U16, Readable.read_u16)
+
+    def read_i16(self): return self._unpack(I16, Readable.read_i16)
+
+    def read_u32(self): return self._unpack(U32, Readable.read_u32)
+
+    def read_i32(self): return self._unpack(I32, Readable.read_i32)
+
+    def read_u64(self): return self._unpack(U64, Readable.read_u64)
+
+    def read_i64(self): return self._unpack(I64, Readable.read_i64)
+
+    def read_charcode(self):
+        # 越界时Readable.read_charcode已经减去偏移，不能再减
+        pos = self.pos
+        if pos + CHARCODE.size > len(self.buf): return Readable.read_charcode(self)
+        self.pos = pos + CHARCODE.size
+        return CHARCODE.unpack_from(self.buf, pos)[0] - 0x8000
+
+    def read_zstr(self):
+        # re可以直接在bytes、memoryview、mmap上查找
+        found = ZERO_BYTE.search(self.buf, self.pos)
+        if found is None: raise EOFError('unterminated string')
+        result = bytes(self.buf[self.pos:found.start()])
+        self.pos = found.end()
+        return result
+
+class ViewBuffer(ROBuffer):
+    # read返回memoryview切片，不复制数据；需要长期保存的结果应自行转为bytes
+    buf: memoryview
+
+    def __init__(self, buf: ByteString):
+        super().__init__(memoryview(buf).cast('B'))
+
+class MMapReader(ViewBuffer):
+    _mmap: Optional[mmap.mmap]
+
+    def __init__(self, mm: Optional[mmap.mmap]):
+        super().__init__(b'' if mm is None else mm)
+        self._mmap = mm
+
+    @classmethod
+    def open(cls, path: str | Path):
+        with open(path, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size == 0: return cls(None) # 空文件无法映射
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            if stats.active is not None: stats.active.add_io('io.mmap', len(mm))
+            return cls(mm)
+
+    def close(self):
+        self.buf.release()
+        if self._mmap is not None:
+            # 仍有切片在外部使用时无法关闭，交给垃圾回收处理
+            try: self._mmap.close()
+            except BufferError: pass
+            self._mmap = None
+
+    def __enter__(self): return self
+
+    def __exit__(self, *exc): self.close()
+
 class FileWrapper(RandomAccessible):
     fp: BinaryIO
+    _size: Optional[int]
 
     def __init__(self, fp: BinaryIO):
         self.fp = fp
+        self._size = None
 
     def tell(self): return self.fp.tell()
 
     def size(self):
-        pos = self.fp.tell()
-        self.fp.seek(0, SEEK_END)
-        size = self.fp.tell()
-        self.fp.seek(pos)
-        return size
+        # 写入后才需要重新计算
+        if self._size is None:
+            pos = self.fp.tell()
+            self.fp.seek(0, SEEK_END)
+            self._size = self.fp.tell()
+            self.fp.seek(pos)
+        return self._size
 
-    def read(self, size: int): return self.fp.read(size)
+    def read(self, size: int):
+        result = self.fp.read(size)
+        if stats.active is not None: stats.active.add_io('io.read', len(result))
+        return result
 
-    def write(self, data: ByteString): self.fp.write(data)
+    def read_zstr(self):
+        # 分块读取后退回多读的部分
+        result = bytearray()
+        while chunk := self.fp.read(ZSTR_CHUNK_SIZE):
+            if stats.active is not None: stats.active.add_io('io.read', len(chunk))
+            end = chunk.find(b'\0')
+            if end >= 0:
+                result.extend(chunk[:end])
+                self.fp.seek(end + 1 - len(chunk), SEEK_CUR)
+                return bytes(result)
+            result.extend(chunk)
+        raise EOFError('unterminated string')
+
+    def write(self, data: ByteString):
+        self._size = None
+        self.fp.write(data)
+        if stats.active is not None: stats.active.add_io('io.write', len(data))
+
+    def write_from(self, src: BinaryIO, size: int, src_offset: Optional[int] = None):
+        self._size = None
+        copy_stream(src, self.fp, size, src_offset)
+
+    def writev(self, buffers: Iterable[ByteString]):
+        self._size = None
+        writev(self.fp, buffers)
 
     def seek(self, pos: int): self.fp.seek(pos)
+
+class BufferedWriter(RandomWritable):
+    # 先写进预分配的缓冲区，攒满后整块写出
+    # 超出文件末尾的大段补0直接跳过，最后用truncate补齐，由文件系统留成空洞
+    fp: BinaryIO
+    buf: bytearray
+    buf_start: int # 缓冲区开头对应的文件位置
+    buf_len: int
+    file_end: int # 文件中已经实际存在的数据末尾
+    end: int # 写入（含跳过的补0）的最远位置
+
+    def __init__(self, fp: BinaryIO, capacity: int = WRITE_BUFFER_SIZE):
+        self.fp = fp
+        self.buf = bytearray(capacity)
+        self.buf_start = fp.tell()
+        self.buf_len = 0
+        self.file_end = fp.seek(0, SEEK_END)
+        fp.seek(self.buf_start)
+        self.end = self.file_end
+
+    def __enter__(self): return self
+
+    def __exit__(self, *exc): self.flush()
+
+    def flush(self):
+        if self.buf_len:
+            self.fp.seek(self.buf_start)
+            self.fp.write(memoryview(self.buf)[:self.buf_len])
+            if stats.active is not None: stats.active.add_io('io.write', self.buf_len)
+            self.buf_start += self.buf_len
+            self.buf_len = 0
+            self.file_end = max(self.file_end, self.buf_start)
+        if self.end > self.file_end:
+            self.fp.truncate(self.end)
+            self.file_end = self.end
+        self.fp.seek(self.buf_start)
+
+    def tell(self): return self.buf_start + self.buf_len
+
+    def size(self): return max(self.end, self.tell())
+
+    def seek(self, pos: int):
+        if self.buf_len: self.flush()
+        self.buf_start = pos
+
+    def _reserve(self, size: int):
+        # 返回可以写入size字节的缓冲区位置
+        if self.buf_len + size > len(self.buf): self.flush()
+        pos = self.buf_len
+        self.buf_len += size
+        self.end = max(self.end, self.buf_start + self.buf_len)
+        return pos
+
+    def write(self, data: ByteString):
+        size = len(data)
+        if size >= len(self.buf):
+            self.flush()
+            self.fp.write(data)
+            if stats.active is not None: stats.active.add_io('io.write', size)
+            self.buf_start += size
+            self.file_end = max(self.file_end, self.buf_start)
+            self.end = max(self.end, self.buf_start)
+        else:
+            pos = self._reserve(size)
+            self.buf[pos:pos + size] = data
+
+    def _pack(self, fmt: struct.Struct, val: int):
+        end = self.end
+        try: fmt.pack_into(self.buf, self._reserve(fmt.size), val)
+        except struct.error as e:
+            # 与int.to_bytes的行为保持一致
+            self.buf_len -= fmt.size; self.end = end
+            raise OverflowError(str(e)) from None
+
+    def write_u8(self, val: int): self._pack(U8, val)
+
+    def write_i8(self, val: int): self._pack(I8, val)
+
+    def write_u16(self, val: int): self._pack(U16, val)
+
+    def write_i16(self, val: int): self._pack(I16, val)
+
+    def write_u32(self, val: int): self._pack(U32, val)
+
+    def write_i32(self, val: int): self._pack(I32, val)
+
+    def write_u64(self, val: int): self._pack(U64, val)
+
+    def write_i64(self, val: int): self._pack(I64, val)
+
+    def write_charcode(self, val: int): self._pack(CHARCODE, val + 0x8000)
+
+    def pad(self, size: int, pattern: ByteString = b'\0'):
+        if size <= 0: return
+        if pattern.count(0) != len(pattern): return super().pad(size, pattern)
+        start = self.tell()
+        if start >= self.file_end and size >= HOLE_MIN_SIZE:
+            # 文件末尾之后的区域本来就是0，跳过即可
+            if stats.active is not None: stats.active.add_io('io.hole', size)
+            self.seek(start + size)
+            self.end = max(self.end, start + size)
+        elif size <= len(self.buf):
+            pos = self._reserve(size)
+            self.buf[pos:pos + size] = bytes(size)
+        else: super().pad(size, pattern)
+
+    def write_from(self, src: BinaryIO, size: int, src_offset: Optional[int] = None):
+        self.flush()
+        copy_stream(src, self.fp, size, src_offset)
+        self.buf_start += size
+        self.file_end = max(self.file_end, self.buf_start)
+        self.end = max(self.end, self.buf_start)
+
+    def writev(self, buffers: Iterable[ByteString]):
+        # 放得进缓冲区时照常缓冲，否则连同缓冲区中的数据一次写出
+        # 相邻的小段先拼接起来，避免大量很短的iovec
+        buffers = list(buffers)
+        size = sum(map(len, buffers))
+        if self.buf_len + size <= len(self.buf):
+            for buf in buffers: self.write(buf)
+            return
+        iov = list[ByteString]()
+        if self.buf_len: iov.append(memoryview(self.buf)[:self.buf_len])
+        small = list[ByteString]()
+        for buf in buffers:
+            if len(buf) < WRITEV_MIN_SIZE:
+                small.append(buf)
+                continue
+            if small: iov.append(b''.join(small)); small.clear()
+            iov.append(buf)
+        if small: iov.append(b''.join(small))
+        self.buf_len = 0
+        self.fp.seek(self.buf_start)
+        size = writev(self.fp, iov)
+        self.buf_start += size
+        self.file_end = max(self.file_end, self.buf_start)
+        self.end = max(self.end, self.buf_start)
+
+COPY_CHUNK_SIZE = 1 << 20
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') and 'SC_IOV_MAX' in os.sysconf_names else 1024
+
+def _kernel_copy(src: BinaryIO, src_offset: int, dst: BinaryIO, dst_offset: int, size: int) -> int:
+    # 两端都是真实文件时用copy_file_range在内核中按给定位置复制，返回已复制的大小
+    # 不是真实文件、跨文件系统等情况下复制不完整，剩余部分由调用方分块复制
+    done = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            src_fd, dst_fd = src.fileno(), dst.fileno()
+            while done < size:
+                copied = os.copy_file_range(src_fd, dst_fd, size - done, src_offset + done, dst_offset + done)
+                if stats.active is not None: stats.active.add_io('io.copy_file_range', copied)
+                if copied == 0: break
+                done += copied
+        except (OSError, AttributeError): pass
+    return done
+
+def copy_stream(src: BinaryIO, dst: BinaryIO, size: int, src_offset: Optional[int] = None):
+    # 从src的src_offset处（默认为当前位置）复制size字节到dst的当前位置，结束后两端都定位到复制的末尾
+    if src_offset is None: src_offset = src.tell()
+    dst.flush()
+    dst_offset = dst.tell()
+    done = _kernel_copy(src, src_offset, dst, dst_offset, size)
+    if done < size:
+        src.seek(src_offset + done)
+        dst.seek(dst_offset + done)
+        while done < size:
+            chunk = src.read(min(COPY_CHUNK_SIZE, size - done))
+            if not chunk: break
+            dst.write(chunk)
+            if stats.active is not None: stats.active.add_io('io.copy', len(chunk))
+            done += len(chunk)
+    if done < size: raise EOFError('source ended before all data was copied')
+    src.seek(src_offset + size)
+    dst.seek(dst_offset + size)
+
+def copy_range(src: BinaryIO, src_offset: int, dst: BinaryIO, dst_offset: int, size: int):
+    # 与copy_stream相同，但两端都按给定位置读写，不使用也不改变文件位置，可在多个线程中并发调用
+    # dst不能有未写出的缓冲数据
+    done = _kernel_copy(src, src_offset, dst, dst_offset, size)
+    while done < size:
+        chunk = pread(src, min(COPY_CHUNK_SIZE, size - done), src_offset + done)
+        if not chunk: break
+        pwrite(dst, chunk, dst_offset + done)
+        done += len(chunk)
+    if done < size: raise EOFError('source ended before all data was copied')
+
+# 没有os.pread/os.pwrite的平台上用锁保证seek与读写不被打断
+_position_lock = threading.Lock()
+
+if hasattr(os, 'pread'):
+    def pread(fp: BinaryIO, size: int, offset: int) -> bytes:
+        # 不改变文件位置的定位读取，可在多个线程中共用同一个文件
+        result = os.pread(fp.fileno(), size, offset)
+        if stats.active is not None: stats.active.add_io('io.pread', len(result))
+        return result
+else:
+    def pread(fp: BinaryIO, size: int, offset: int) -> bytes:
+        with _position_lock:
+            pos = fp.tell()
+            fp.seek(offset)
+            try: result = fp.read(size)
+            finally: fp.seek(pos)
+        if stats.active is not None: stats.active.add_io('io.pread', len(result))
+        return result
+
+if hasattr(os, 'pwrite'):
+    def pwrite(fp: BinaryIO, data: ByteString, offset: int):
+        # 不改变文件位置的定位写入，fp不能有未写出的缓冲数据
+        view = memoryview(data).cast('B')
+        done = 0
+        while done < len(view):
+            done += os.pwrite(fp.fileno(), view[done:], offset + done)
+        if stats.active is not None: stats.active.add_io('io.pwrite', done)
+else:
+    def pwrite(fp: BinaryIO, data: ByteString, offset: int):
+        with _position_lock:
+            pos = fp.tell()
+            fp.seek(offset)
+            try:
+                fp.write(data)
+                fp.flush()
+            finally: fp.seek(pos)
+        if stats.active is not None: stats.active.add_io('io.pwrite', len(data))
+
+def writev(fp: BinaryIO, buffers: Iterable[ByteString]) -> int:
+    # 在当前位置一次写出多段数据（gather write），返回写出的总大小
+    views = [view for view in (memoryview(buf).cast('B') for buf in buffers) if len(view)]
+    size = sum(map(len, views))
+    try: fd = fp.fileno() if hasattr(os, 'writev') else None
+    except OSError: fd = None # 没有文件描述符，如BytesIO
+    if fd is None:
+        for view in views: fp.write(view)
+    else:
+        fp.flush()
+        pos = fp.tell()
+        os.lseek(fd, pos, os.SEEK_SET)
+        idx = 0
+        while idx < len(views):
+            written = os.writev(fd, views[idx:idx + IOV_MAX])
+            # 跳过已完整写出的部分，部分写出的从剩余处继续
+            while idx < len(views) and written >= len(views[idx]):
+                written -= len(views[idx]); idx += 1
+            if written: views[idx] = views[idx][written:]
+        fp.seek(pos + size)
+    if stats.active is not None: stats.active.add_io('io.writev', size)
+    return size
+
+def preallocate(fp: BinaryIO, size: int):
+    # 预先把文件扩展到最终大小，支持时同时分配磁盘空间；新扩展的部分都是0
+    fp.flush()
+    if hasattr(os, 'posix_fallocate'):
+        try: os.posix_fallocate(fp.fileno(), 0, size)
+        except OSError: pass # 文件系统不支持
+    fp.truncate(size)
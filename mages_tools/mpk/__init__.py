@@ -1,2 +1,6 @@
-from .layout import MPKLayout as Layout
-from .utils import unpack, repack
+from .layout import MPKLayout as Layout, MPKEntry as Entry
+from .lazy import LazyMPKLayout as LazyLayout
+from .utils import unpack, repack, update, compact
+from .aio import AsyncMPKReader as AsyncReader, aunpack, arepack
+from .index import MPKIndex as Index, build_index
+from .diff import MPKDiff as Diff, diff
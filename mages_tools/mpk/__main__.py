@@ -1,22 +1,87 @@
 from pathlib import Path
-from mages_tools.mpk import unpack, repack
+from typing import Optional
+import json
+import sys
+from mages_tools import stats
+from mages_tools.mpk import unpack, repack, update, compact, Index, build_index, diff
+from mages_tools.mpk.utils import changed_files
+from mages_tools.mpk.compression import compress_suffixes
 
 import click
 
 @click.group()
-def cli():
-    pass
+@click.option('--stats', 'show_stats', is_flag=True, help='print per-stage timings and I/O counters to stderr')
+@click.option('--stats-json', type=click.Path(dir_okay=False, allow_dash=True), help='write timings and counters as JSON (- for stdout)')
+@click.pass_context
+def cli(ctx: click.Context, show_stats: bool, stats_json: Optional[str]):
+    if not (show_stats or stats_json): return
+    collected = stats.enable()
+    def report():
+        if show_stats: print(collected.summary(), file=sys.stderr)
+        if stats_json == '-': print(json.dumps(collected.to_json(), indent=2))
+        elif stats_json: Path(stats_json).write_text(json.dumps(collected.to_json(), indent=2))
+    ctx.call_on_close(report)
 
 @cli.command()
 @click.argument('src')
 @click.argument('dst')
-def upk(src: str, dst: str):
-    unpack(Path(src), Path(dst))
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=1, help='number of extraction threads')
+@click.option('--manifest', is_flag=True, help='write a manifest for incremental repacking')
+def upk(src: str, dst: str, jobs: int, manifest: bool):
+    unpack(Path(src), Path(dst), jobs, manifest)
 
 @cli.command()
 @click.argument('src')
 @click.argument('dst')
-def rpk(src: str, dst: str):
-    repack(Path(src), Path(dst))
+@click.option('--update', 'update_mode', is_flag=True, help='replace changed entries of the existing archive in place')
+@click.option('--compact', 'compact_after', is_flag=True, help='compact the archive after updating')
+@click.option('--manifest', is_flag=True, help='reuse unchanged entries recorded in the manifest (with --update: detect changes through it)')
+@click.option('--compress', 'compress', multiple=True, help='zlib-compress entries whose names end with this suffix (repeatable)')
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=None, help='number of compression and writer threads')
+def rpk(src: str, dst: str, update_mode: bool, compact_after: bool, manifest: bool, compress: tuple[str, ...], jobs: Optional[int]):
+    if update_mode:
+        src_path = Path(src)
+        archive = Path(dst) / (src_path.name + '.mpk')
+        # 只替换有变化的文件，未修改的记录保持原样，archive不会每次都变大
+        replaces = changed_files(src_path, archive, manifest)
+        if replaces: update(archive, replaces)
+        if compact_after: compact(archive)
+    else:
+        policy = compress_suffixes(suffix.encode() for suffix in compress) if compress else None
+        repack(Path(src), Path(dst), manifest, policy=policy, jobs=jobs)
+
+@cli.command('index')
+@click.argument('src')
+@click.argument('index')
+@click.option('--pattern', default='*.mpk', help='archive file pattern, searched recursively')
+@click.option('--rescan', is_flag=True, help='ignore the existing index and scan every archive')
+def index_cmd(src: str, index: str, pattern: str, rescan: bool):
+    build_index(Path(src), Path(index), pattern, rescan)
+
+@cli.command()
+@click.argument('index')
+@click.argument('name')
+@click.option('--output', '-o', type=click.Path(dir_okay=False), help='extract the entry to this file')
+def find(index: str, name: str, output: Optional[str]):
+    with Index.open(index) as idx:
+        found = list(idx.find_all(name.encode()))
+        if not found: raise click.ClickException(f'{name} not found')
+        for entry in found:
+            click.echo(f'{entry.archive}\t{entry.offset:#x}\t{entry.size}\t{entry.also_size}')
+        if output is not None: Path(output).write_bytes(idx.read(name.encode()))
+
+@cli.command('diff')
+@click.argument('old')
+@click.argument('new')
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=None, help='number of hashing threads')
+@click.option('--scx-suffix', 'scx_suffixes', multiple=True, default=['.scx'], help='entries compared string by string (repeatable)')
+def diff_cmd(old: str, new: str, jobs: Optional[int], scx_suffixes: tuple[str, ...]):
+    result = diff(Path(old), Path(new), jobs, (suffix.encode() for suffix in scx_suffixes))
+    for mark, names in (('A', result.added), ('D', result.removed), ('M', result.modified)):
+        for name in names:
+            click.echo(f'{mark} {name.decode()}')
+            if (strings := result.strings.get(name)) is not None:
+                for smark, indices in (('A', strings.added), ('D', strings.removed), ('M', strings.modified)):
+                    for stridx in indices: click.echo(f'  {smark} string {stridx}')
 
 cli()
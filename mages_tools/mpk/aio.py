@@ -0,0 +1,86 @@
+from typing import BinaryIO, Optional, Iterator
+from pathlib import Path
+import asyncio
+import threading
+from mages_tools.errors import *
+from mages_tools.aio import AsyncRunner, DEFAULT_RUNNER
+from .layout import MPKLayout, MPKEntry, FileWrapper, pread
+from . import compression
+from .utils import extract_entry, write_unpack_manifest, repack
+
+# 异步接口：阻塞的文件操作都经由AsyncRunner执行，不占用事件循环
+# 取消时会等已经开始的读写结束后再关闭文件
+
+def load_table_from(path: Path):
+    fp = open(path, 'rb')
+    try: return fp, *MPKLayout.load_table(FileWrapper(fp))
+    except BaseException:
+        fp.close(); raise
+
+def read_entry(fp: BinaryIO, entry: MPKEntry):
+    result = pread(fp, entry.size, entry.offset)
+    if len(result) != entry.size: raise InvalidDataError(f"entry {repr(entry.name)} out of range")
+    return compression.decompress(entry.compression, result, entry.also_size)
+
+class AsyncMPKReader:
+    magic: int
+    table: list[MPKEntry]
+    index: dict[bytes, MPKEntry]
+    runner: AsyncRunner
+    _fp: Optional[BinaryIO]
+
+    def __init__(self, fp: BinaryIO, magic: int, table: list[MPKEntry], runner: AsyncRunner = DEFAULT_RUNNER):
+        self.magic = magic
+        self.table = table
+        # 同名记录以数据靠后的为准
+        self.index = {entry.name: entry for entry in sorted(table, key=lambda e: e.offset)}
+        self.runner = runner
+        self._fp = fp
+
+    @classmethod
+    async def open(cls, path: str | Path, runner: AsyncRunner = DEFAULT_RUNNER):
+        return cls(*await runner.run(load_table_from, Path(path)), runner)
+
+    async def close(self):
+        if self._fp is not None:
+            await self.runner.run(self._fp.close)
+            self._fp = None
+
+    async def __aenter__(self): return self
+
+    async def __aexit__(self, *exc): await self.close()
+
+    def __len__(self): return len(self.index)
+
+    def __iter__(self) -> Iterator[bytes]: return iter(self.index)
+
+    def __contains__(self, name: bytes): return name in self.index
+
+    async def read(self, name: bytes) -> bytes:
+        return await self.runner.run(read_entry, self._fp, self.index[name])
+
+    async def extract(self, name: bytes, path: Path, digest: bool = False):
+        return await self.runner.run(extract_entry, self._fp, self.index[name], path, digest)
+
+async def gather_or_cancel(*aws):
+    # 任意一个失败或整体被取消时，取消其余任务并等它们结束
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try: return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks: task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def aunpack(src: Path, dst: Path, manifest: bool = False, runner: AsyncRunner = DEFAULT_RUNNER):
+    if not (src.is_file() and dst.is_dir()):
+        raise ValueError('invalid path')
+    async with await AsyncMPKReader.open(src, runner) as reader:
+        basedir = dst / src.stem
+        basedir.mkdir(exist_ok=True)
+        names = list(reader)
+        results = await gather_or_cancel(*(reader.extract(name, basedir / name.decode(), manifest) for name in names))
+    if manifest: await runner.run(write_unpack_manifest, src, basedir, reader.magic, names, results)
+
+async def arepack(src: Path, dst: Path, manifest: bool = False, runner: AsyncRunner = DEFAULT_RUNNER):
+    stop = threading.Event()
+    await runner.run(repack, src, dst, manifest, stop, on_cancel=stop.set)
@@ -0,0 +1,83 @@
+from typing import ByteString, Callable, Optional, Iterable, Iterator, TypeVar
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import os
+import zlib
+from mages_tools.errors import *
+from mages_tools import stats
+
+# 记录表项第一个字段为压缩方式：size为存储的大小，also_size为解压后的大小
+
+NONE = 0
+ZLIB = 1
+
+@dataclass(slots=True, frozen=True)
+class Compression:
+    method: int
+    name: str
+    compress: Callable[[ByteString], bytes]
+    decompress: Callable[[ByteString, int], bytes] # (存储的数据, 解压后的大小)
+
+registry = dict[int, Compression]()
+
+def register(codec: Compression):
+    registry[codec.method] = codec
+    return codec
+
+register(Compression(ZLIB, 'zlib', zlib.compress, lambda data, size: zlib.decompress(data, bufsize=max(size, 1))))
+
+def get(method: int):
+    try: return registry[method]
+    except KeyError: raise InvalidDataError(f"unknown compression method {method}") from None
+
+# 按记录名决定写入时的压缩方式
+Policy = Callable[[bytes], int]
+
+def compress_all(method: int = ZLIB) -> Policy:
+    get(method)
+    return lambda name: method
+
+def compress_suffixes(suffixes: Iterable[bytes], method: int = ZLIB) -> Policy:
+    get(method)
+    suffixes = tuple(suffixes)
+    return lambda name: method if name.endswith(suffixes) else NONE
+
+def compress(method: int, payload: ByteString) -> ByteString:
+    if method == NONE: return payload
+    stats.count('mpk.compress.bytes', len(payload))
+    return get(method).compress(payload)
+
+def decompress(method: int, data: ByteString, size: int) -> ByteString:
+    if method == NONE: return data
+    stats.count('mpk.decompress.bytes', size)
+    result = get(method).decompress(data, size)
+    if len(result) != size: raise InvalidDataError("decompressed size mismatch")
+    return result
+
+def map_parallel(func, items: list[tuple], jobs: Optional[int]):
+    # zlib在压缩与解压时释放GIL，用线程池即可并行
+    if jobs == 1 or sum(item[0] != NONE for item in items) <= 1: return [func(*item) for item in items]
+    with ThreadPoolExecutor(jobs) as pool:
+        return list(pool.map(func, *zip(*items)))
+
+T = TypeVar('T')
+
+def map_ordered(func: Callable[..., T], items: Iterable[tuple], jobs: Optional[int] = None) -> Iterator[T]:
+    # 与map_parallel相同但逐个按顺序给出结果，同时提交的最多为线程数的两倍，结果不会全部留在内存中
+    if jobs == 1:
+        for item in items: yield func(*item)
+        return
+    window = 2 * (jobs or os.cpu_count() or 1)
+    with ThreadPoolExecutor(jobs) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(func, *item))
+            if len(pending) >= window: yield pending.popleft().result()
+        while pending: yield pending.popleft().result()
+
+def compress_many(items: list[tuple[int, ByteString]], jobs: Optional[int] = None):
+    return map_parallel(compress, items, jobs)
+
+def decompress_many(items: list[tuple[int, ByteString, int]], jobs: Optional[int] = None):
+    return map_parallel(decompress, items, jobs)
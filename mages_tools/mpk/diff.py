@@ -0,0 +1,61 @@
+from typing import ByteString, Optional, Iterable
+from pathlib import Path
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from mages_tools.errors import *
+from mages_tools import stats
+from mages_tools.scx.diff import StringDiff, diff_strings
+from .lazy import LazyMPKLayout
+from .manifest import new_hash
+
+# 只读取两边的记录表，再按需比较记录数据，不解包到磁盘
+
+@dataclass(slots=True)
+class MPKDiff:
+    added: list[bytes] = field(default_factory=list)
+    removed: list[bytes] = field(default_factory=list)
+    modified: list[bytes] = field(default_factory=list)
+    unchanged: int = 0
+    strings: dict[bytes, StringDiff] = field(default_factory=dict) # 修改过的SCX记录中各字符串的变化
+
+def payload_hash(data: ByteString):
+    # hashlib在数据较大时释放GIL，可在线程池中并行
+    hasher = new_hash()
+    hasher.update(data)
+    return hasher.digest()
+
+def diff(old_path: Path, new_path: Path, jobs: Optional[int] = None, scx_suffixes: Iterable[bytes] = (b'.scx',)):
+    scx_suffixes = tuple(scx_suffixes)
+    result = MPKDiff()
+    with LazyMPKLayout.open(old_path) as old, LazyMPKLayout.open(new_path) as new:
+        result.removed = [name for name in old if name not in new]
+        result.added = [name for name in new if name not in old]
+        # 解压后大小不同的一定有变化，不用计算哈希
+        candidates = list[bytes]()
+        for name in old:
+            if name not in new: continue
+            if old.index[name].also_size != new.index[name].also_size: result.modified.append(name)
+            else: candidates.append(name)
+        stats.count('mpk.diff.size_mismatch', len(result.modified))
+        with ThreadPoolExecutor(jobs) as pool, stats.stage('mpk.diff.hash'):
+            # 压缩方式相同时比较存储的数据，否则比较解压后的数据
+            def side_hashes(name: bytes):
+                old_entry, new_entry = old.index[name], new.index[name]
+                if old_entry.compression == new_entry.compression:
+                    if old_entry.size != new_entry.size: return None
+                    return payload_hash(old.view(name)), payload_hash(new.view(name))
+                return payload_hash(old.read(name)), payload_hash(new.read(name))
+            for name, hashes in zip(candidates, pool.map(side_hashes, candidates)):
+                if hashes is None or hashes[0] != hashes[1]: result.modified.append(name)
+                else: result.unchanged += 1
+            stats.count('mpk.diff.hashed', len(candidates))
+            # SCX记录继续逐字符串比较
+            scx_names = [name for name in result.modified if name.endswith(scx_suffixes)]
+            def scx_diff(name: bytes):
+                try: return diff_strings(old.read(name), new.read(name))
+                except InvalidDataError: return None # 不是合法的SCX，只报告记录有变化
+            with stats.stage('mpk.diff.strings'):
+                for name, strings in zip(scx_names, pool.map(scx_diff, scx_names)):
+                    if strings is not None: result.strings[name] = strings
+    result.modified.sort()
+    return result
@@ -0,0 +1,224 @@
+from typing import ByteString, Optional, Iterator
+from pathlib import Path
+from dataclasses import dataclass
+import hashlib
+import os
+import struct
+from mages_tools.errors import *
+from mages_tools.io import *
+from mages_tools import stats
+from .layout import MPKLayout
+from . import compression
+
+# 多个MPK文件的记录名索引，格式（小端序）：
+#   文件头   INDEX_HEADER
+#   文件表   每个MPK一项ARCHIVE_STRUCT：路径在字符串区中的位置与长度、大小、修改时间
+#   记录表   每条记录一项RECORD_STRUCT
+#   槽位表   开放寻址（线性探测）的哈希表，槽位存记录序号+1，0为空
+#   字符串区 路径与记录名
+# 查找只需计算名称哈希并探测槽位，全部通过mmap完成，不读入整个索引
+
+INDEX_MAGIC = b'MPKI'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('<4sIIIIQQQQ') # magic, version, 文件数, 记录数, 槽位数, 各区位置
+ARCHIVE_STRUCT = struct.Struct('<IIQQ') # 路径位置, 路径长度, 大小, 修改时间
+RECORD_STRUCT = struct.Struct('<QIIIIQQQ') # 名称哈希, 名称位置, 名称长度, 文件序号, 压缩方式, offset, size, also_size
+SLOT = struct.Struct('<I')
+
+def name_hash(name: bytes):
+    return int.from_bytes(hashlib.blake2b(name, digest_size=8).digest(), 'little')
+
+def slot_count_for(count: int):
+    # 装载因子不超过1/2
+    size = 8
+    while size < count * 2: size <<= 1
+    return size
+
+@dataclass(slots=True)
+class IndexEntry:
+    name: bytes
+    archive: Path
+    offset: int
+    size: int # 存储的大小
+    also_size: int # 解压后的大小
+    compression: int = compression.NONE
+
+@dataclass(slots=True)
+class IndexedArchive:
+    path: Path
+    size: int
+    mtime_ns: int
+
+class MPKIndex:
+    archives: list[IndexedArchive]
+    _archive_of: dict[Path, IndexedArchive]
+    _view: memoryview
+    _reader: Optional[MMapReader]
+    _record_count: int
+    _slot_count: int
+    _records_offset: int
+    _slots_offset: int
+    _strings_offset: int
+
+    def __init__(self, buf: ByteString, base: Path, reader: Optional[MMapReader] = None):
+        view = memoryview(buf)
+        try:
+            if len(view) < INDEX_HEADER.size: raise InvalidDataError("index header truncated")
+            magic, version, archive_count, self._record_count, self._slot_count, archives_offset, \
+                self._records_offset, self._slots_offset, self._strings_offset = INDEX_HEADER.unpack_from(view)
+            if magic != INDEX_MAGIC: raise InvalidDataError("index header mismatch")
+            if version != INDEX_VERSION: raise InvalidDataError(f"unsupported index version {version}")
+            if self._slot_count & (self._slot_count - 1) or self._strings_offset > len(view):
+                raise InvalidDataError("invalid index layout")
+            self.archives = list[IndexedArchive]()
+            for pos, length, size, mtime_ns in ARCHIVE_STRUCT.iter_unpack(view[archives_offset:archives_offset + ARCHIVE_STRUCT.size * archive_count]):
+                rel = bytes(view[self._strings_offset + pos:self._strings_offset + pos + length]).decode()
+                self.archives.append(IndexedArchive(base / rel, size, mtime_ns))
+        except BaseException:
+            view.release(); raise
+        self._archive_of = {archive.path: archive for archive in self.archives}
+        self._view = view
+        self._reader = reader
+
+    @classmethod
+    def open(cls, path: str | Path):
+        path = Path(path)
+        reader = MMapReader.open(path)
+        try: return cls(reader.buf, path.parent, reader)
+        except BaseException:
+            reader.close(); raise
+
+    def close(self):
+        self._view.release()
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def __enter__(self): return self
+
+    def __exit__(self, *exc): self.close()
+
+    def __len__(self): return self._record_count
+
+    def _string(self, pos: int, length: int):
+        start = self._strings_offset + pos
+        return bytes(self._view[start:start + length])
+
+    def _record(self, idx: int):
+        return RECORD_STRUCT.unpack_from(self._view, self._records_offset + RECORD_STRUCT.size * idx)
+
+    def _entry(self, record: tuple):
+        _, name_pos, name_len, archive_idx, method, offset, size, also_size = record
+        return IndexEntry(self._string(name_pos, name_len), self.archives[archive_idx].path, offset, size, also_size, method)
+
+    def find_all(self, name: bytes) -> Iterator[IndexEntry]:
+        # 同名记录可能出现在多个MPK中，按文件表顺序给出
+        hsh = name_hash(name)
+        mask = self._slot_count - 1
+        slot = hsh & mask
+        while (value := SLOT.unpack_from(self._view, self._slots_offset + SLOT.size * slot)[0]) != 0:
+            record = self._record(value - 1)
+            if record[0] == hsh and self._string(record[1], record[2]) == name:
+                yield self._entry(record)
+            slot = (slot + 1) & mask
+
+    def get(self, name: bytes) -> Optional[IndexEntry]:
+        return next(self.find_all(name), None)
+
+    def __getitem__(self, name: bytes):
+        if (entry := self.get(name)) is None: raise KeyError(name)
+        return entry
+
+    def __contains__(self, name: bytes): return self.get(name) is not None
+
+    def __iter__(self) -> Iterator[IndexEntry]:
+        for idx in range(self._record_count): yield self._entry(self._record(idx))
+
+    def read(self, name: bytes) -> ByteString:
+        # 直接定位到记录数据，不解析MPK
+        entry = self[name]
+        with open(entry.archive, 'rb') as fp:
+            archive = self._archive_of[entry.archive]
+            stat = os.fstat(fp.fileno())
+            if stat.st_size != archive.size or stat.st_mtime_ns != archive.mtime_ns:
+                raise InvalidDataError(f"{entry.archive} changed since indexed, rebuild the index")
+            data = pread(fp, entry.size, entry.offset)
+        if len(data) != entry.size: raise InvalidDataError(f"entry {repr(name)} out of range, rebuild the index")
+        return compression.decompress(entry.compression, data, entry.also_size)
+
+def scan_archive(path: Path):
+    # 只读取文件头与记录表；同名记录以数据靠后的为准
+    with open(path, 'rb') as fp:
+        _, table = MPKLayout.load_table(FileWrapper(fp))
+    entries = {entry.name: entry for entry in sorted(table, key=lambda e: e.offset)}
+    return [IndexEntry(name, path, entry.offset, entry.size, entry.also_size, entry.compression) for name, entry in entries.items()]
+
+def relative_path(path: Path, base: Path):
+    return Path(os.path.relpath(path, base)).as_posix()
+
+def write_index(path: Path, archives: list[IndexedArchive], entries: list[list[IndexEntry]]):
+    base = path.parent
+    strings = bytearray()
+    def add_string(value: bytes):
+        pos = len(strings); strings.extend(value)
+        return pos, len(value)
+    archive_raw = bytearray()
+    for archive in archives:
+        archive_raw += ARCHIVE_STRUCT.pack(*add_string(relative_path(archive.path, base).encode()), archive.size, archive.mtime_ns)
+    record_raw = bytearray()
+    hashes = list[int]()
+    for archive_idx, archive_entries in enumerate(entries):
+        for entry in archive_entries:
+            hsh = name_hash(entry.name)
+            hashes.append(hsh)
+            record_raw += RECORD_STRUCT.pack(hsh, *add_string(entry.name), archive_idx, entry.compression, entry.offset, entry.size, entry.also_size)
+    # 按记录顺序插入，同名记录探测时也按文件表顺序出现
+    slot_count = slot_count_for(len(hashes))
+    mask = slot_count - 1
+    slots = [0] * slot_count
+    for idx, hsh in enumerate(hashes):
+        slot = hsh & mask
+        while slots[slot]: slot = (slot + 1) & mask
+        slots[slot] = idx + 1
+    archives_offset = INDEX_HEADER.size
+    records_offset = archives_offset + len(archive_raw)
+    slots_offset = records_offset + len(record_raw)
+    strings_offset = slots_offset + SLOT.size * slot_count
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as fp, BufferedWriter(fp) as data:
+        data.write(INDEX_HEADER.pack(
+            INDEX_MAGIC, INDEX_VERSION, len(archives), len(hashes), slot_count,
+            archives_offset, records_offset, slots_offset, strings_offset,
+        ))
+        data.write(archive_raw)
+        data.write(record_raw)
+        data.write(struct.pack(f'<{slot_count}I', *slots))
+        data.write(strings)
+    os.replace(tmp_path, path)
+
+def build_index(src: Path, path: Path, pattern: str = '*.mpk', rescan: bool = False):
+    # 大小与修改时间都没变的MPK沿用旧索引中的记录，不重新读取
+    if not src.is_dir(): raise ValueError('invalid path')
+    previous = dict[Path, tuple[IndexedArchive, list[IndexEntry]]]()
+    if not rescan and path.is_file():
+        try:
+            with MPKIndex.open(path) as old:
+                grouped = {archive.path: list[IndexEntry]() for archive in old.archives}
+                for entry in old: grouped[entry.archive].append(entry)
+                previous = {archive.path.resolve(): (archive, grouped[archive.path]) for archive in old.archives}
+        except InvalidDataError: pass # 损坏或旧版本的索引直接重建
+    archives = list[IndexedArchive]()
+    entries = list[list[IndexEntry]]()
+    for archive_path in sorted(src.rglob(pattern)):
+        stat = archive_path.stat()
+        archive = IndexedArchive(archive_path, stat.st_size, stat.st_mtime_ns)
+        old = previous.get(archive_path.resolve())
+        if old is not None and old[0].size == stat.st_size and old[0].mtime_ns == stat.st_mtime_ns:
+            stats.count('mpk.index.reused')
+            archive_entries = [IndexEntry(entry.name, archive_path, entry.offset, entry.size, entry.also_size, entry.compression) for entry in old[1]]
+        else:
+            stats.count('mpk.index.scanned')
+            archive_entries = scan_archive(archive_path)
+        archives.append(archive)
+        entries.append(archive_entries)
+    write_index(path, archives, entries)
@@ -1,9 +1,36 @@
-from typing import Optional, Iterable
+from typing import BinaryIO, ByteString, Optional, Iterable, Mapping
 from pathlib import Path
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 import warnings
+import struct
+import threading
 from dataclasses import dataclass
 from mages_tools.errors import *
 from mages_tools.io import *
+from mages_tools import stats
+from mages_tools.aio import AsyncRunner, DEFAULT_RUNNER
+from . import compression
+from .compression import Policy
+
+# 记录数据的来源：内存中的数据、整个文件，或(已打开的文件, 数据位置)
+Source = ByteString | Path | tuple[BinaryIO, int]
+
+def write_source(fp: BinaryIO, offset: int, size: int, source: Source, stop: Optional[threading.Event] = None):
+    if stop is not None and stop.is_set(): raise InterruptedError('assembly cancelled')
+    if isinstance(source, Path):
+        with open(source, 'rb') as src_fp: copy_range(src_fp, 0, fp, offset, size)
+    elif isinstance(source, tuple): copy_range(source[0], source[1], fp, offset, size)
+    else: pwrite(fp, source, offset)
+
+@dataclass(slots=True)
+class MPKEntry:
+    name: bytes
+    index: int # 记录中标注的序号
+    offset: int
+    size: int # 存储的大小
+    also_size: int # 解压后的大小，未压缩时与size相同
+    compression: int = compression.NONE
 
 @dataclass(slots=True)
 class MPKLayout:
@@ -13,11 +40,13 @@ class MPKLayout:
     ENTRY_HEADER_SIZE = 32
     ENTRY_NAME_MAX_SIZE = ENTRY_SIZE - ENTRY_HEADER_SIZE
     ENTRY_DATA_ALIGN_UNIT = 0x800
+    ENTRY_STRUCT = struct.Struct(f'<IIQQQ{ENTRY_NAME_MAX_SIZE}s')
 
     entries: dict[bytes, bytes]
     magic: int = DEFAULT_MAGIC
     entry_order: Optional[list[tuple[bytes, int]]] = None # 记录表的排列顺序，可忽略
     data_order: Optional[list[bytes]] = None # 记录数据的排列顺序，可忽略
+    compression: Optional[dict[bytes, int]] = None # 各记录读入时的压缩方式，写出时默认沿用
 
     @classmethod
     def next_aligned(cls, addr: int):
@@ -36,85 +65,164 @@ class MPKLayout:
         else: return sorted(self.entries.keys())
 
     @classmethod
-    def load(cls, data: Readable):
-        # 检查文件头
-        if data.read(len(cls.HEADER)) != cls.HEADER:
-            raise InvalidDataError("MPK header mismatch")
-        # 读取魔数
-        magic = data.read_u32()
-        # 读取记录总数
-        count = data.read_i32()
-        if count <= 0: raise InvalidDataError("invalid entry count")
-        data.read_until(0x40) # 跳过对齐
-        # 读取记录表
-        entry_order = list[tuple[bytes, int]]()
-        entry_pos = list[tuple[int, int]]()
-        for entry_idx in range(count):
-            data.read_u32() # 跳过对齐
-            marked_idx = data.read_u32()
-            if entry_idx != marked_idx: warnings.warn("entry index mismatch", InformalDataWarning)
-            offset = data.read_u64()
-            if offset % cls.ENTRY_DATA_ALIGN_UNIT != 0: warnings.warn("entry data is not aligned", InformalDataWarning)
-            size = data.read_u64(); also_size = data.read_u64()
-            if size != also_size: warnings.warn("redundant entry size mismatch", InformalDataWarning)
-            name = data.read_zstr()
-            entry_order.append((name, marked_idx))
-            entry_pos.append((offset, size))
-            data.read(cls.ENTRY_NAME_MAX_SIZE - len(name) - 1)
-        # 读取记录数据
-        entry_index = sorted(range(len(entry_pos)), key=lambda i: entry_pos[i][0])
-        entries = dict[bytes, bytes]()
-        data_order = list[bytes]()
-        for idx in entry_index:
-            offset, size = entry_pos[idx]
-            name, _ = entry_order[idx]
-            data.read_until(offset)
-            entries[name] = data.read(size)
-            data_order.append(name)
+    def load_table(cls, data: Readable):
+        with stats.stage('mpk.load_table'):
+            # 检查文件头
+            if data.read(len(cls.HEADER)) != cls.HEADER:
+                raise InvalidDataError("MPK header mismatch")
+            # 读取魔数
+            magic = data.read_u32()
+            # 读取记录总数
+            count = data.read_i32()
+            if count <= 0: raise InvalidDataError("invalid entry count")
+            data.read_until(0x40) # 跳过对齐
+            # 一次读入整个记录表再批量解码
+            raw = data.read(count * cls.ENTRY_SIZE)
+            if len(raw) != count * cls.ENTRY_SIZE: raise InvalidDataError("entry table truncated")
+            table = list[MPKEntry]()
+            for method, marked_idx, offset, size, also_size, name_field in cls.ENTRY_STRUCT.iter_unpack(raw):
+                name_end = name_field.find(b'\0')
+                if name_end < 0: raise InvalidDataError("entry name not terminated")
+                table.append(MPKEntry(name_field[:name_end], marked_idx, offset, size, also_size, method))
+            # 校验
+            if any(entry.index != entry_idx for entry_idx, entry in enumerate(table)):
+                warnings.warn("entry index mismatch", InformalDataWarning)
+                stats.count('warnings')
+            if any(entry.offset % cls.ENTRY_DATA_ALIGN_UNIT != 0 for entry in table):
+                warnings.warn("entry data is not aligned", InformalDataWarning)
+                stats.count('warnings')
+            if any(entry.size != entry.also_size for entry in table if entry.compression == compression.NONE):
+                warnings.warn("redundant entry size mismatch", InformalDataWarning)
+                stats.count('warnings')
+        return magic, table
+
+    @classmethod
+    def load(cls, data: Readable, jobs: Optional[int] = None):
+        magic, table = cls.load_table(data)
+        entry_order = [(entry.name, entry.index) for entry in table]
+        with stats.stage('mpk.load.data'):
+            # 读取记录数据
+            stored = list[tuple[int, ByteString, int]]()
+            data_order = list[bytes]()
+            for entry in sorted(table, key=lambda e: e.offset):
+                data.read_until(entry.offset)
+                stored.append((entry.compression, data.read(entry.size), entry.also_size))
+                data_order.append(entry.name)
+        with stats.stage('mpk.load.decompress'):
+            # 压缩的记录在线程池中并行解压；data可能返回memoryview，统一转为bytes
+            payloads = compression.decompress_many(stored, jobs)
+            entries = {name: bytes(payload) for name, payload in zip(data_order, payloads)}
+        methods = {entry.name: entry.compression for entry in table if entry.compression != compression.NONE}
         # 返回结果
         return cls(
             entries=entries,
             magic=magic,
             entry_order=entry_order,
             data_order=data_order,
+            compression=methods or None,
         )
 
-    def dump(self, data: Writable, follow_given_order: bool = False):
-        # 写入文件头
-        data.write(self.HEADER)
-        # 写入魔数
-        data.write_u32(self.magic)
-        # 写入记录总数
-        data.write_i32(len(self.entries))
-        data.pad_until(0x40) # 对齐
-        # 写入记录表
+    @classmethod
+    def data_start(cls, count: int):
+        # 记录表之后第一条数据的位置
+        return cls.next_aligned(0x40 + cls.ENTRY_SIZE * count)
+
+    @classmethod
+    def plan(cls, entry_order: Iterable[tuple[bytes, int]], data_sizes: Iterable[tuple[bytes, int]]):
+        # 按数据顺序计算各记录对齐后的位置，返回按记录表顺序排列的记录
+        data_sizes = list(data_sizes)
         entry_pos = dict[bytes, tuple[int, int]]()
-        entry_offset = self.next_aligned(0x40 + self.ENTRY_SIZE * len(self.entries))
-        for name in self.data_dump_order(follow_given_order):
-            entry_data = self.entries[name]
-            entry_pos[name] = (entry_offset, len(entry_data))
-            entry_offset = self.next_aligned(entry_offset + len(entry_data))
-        for name, marked_idx in self.entry_dump_order(follow_given_order):
-            data.write_u32(0) # 对齐
-            data.write_u32(marked_idx)
+        entry_offset = cls.data_start(len(data_sizes))
+        for name, size in data_sizes:
+            entry_pos[name] = (entry_offset, size)
+            entry_offset = cls.next_aligned(entry_offset + size)
+        table = list[MPKEntry]()
+        for name, marked_idx in entry_order:
             offset, size = entry_pos[name]
-            data.write_u64(offset)
-            data.write_u64(size); data.write_u64(size)
-            if len(name) + 1 > self.ENTRY_NAME_MAX_SIZE:
-                raise InvalidDataError(f"entry name {repr(name)} too long")
-            data.write_zstr(name)
-            data.pad(self.ENTRY_NAME_MAX_SIZE - len(name) - 1)
-        # 写入记录数据
-        for name in self.data_dump_order(follow_given_order):
-            offset, _ = entry_pos[name]
-            data.pad_until(offset)
-            data.write(self.entries[name])
+            table.append(MPKEntry(name, marked_idx, offset, size, size))
+        return table
+
+    @classmethod
+    def dump_table(cls, data: Writable, magic: int, table: list[MPKEntry]):
+        with stats.stage('mpk.dump.table'):
+            # 写入文件头
+            data.write(cls.HEADER)
+            # 写入魔数
+            data.write_u32(magic)
+            # 写入记录总数
+            data.write_i32(len(table))
+            data.pad_until(0x40) # 对齐
+            # 写入记录表
+            for entry in table:
+                if len(entry.name) + 1 > cls.ENTRY_NAME_MAX_SIZE:
+                    raise InvalidDataError(f"entry name {repr(entry.name)} too long")
+                # 名称不足部分由struct补0
+                data.write(cls.ENTRY_STRUCT.pack(entry.compression, entry.index, entry.offset, entry.size, entry.also_size, entry.name))
+
+    def compression_of(self, name: bytes, policy: Optional[Policy]):
+        if policy is not None: return policy(name)
+        if self.compression is None: return compression.NONE
+        return self.compression.get(name, compression.NONE)
+
+    @classmethod
+    def assemble(cls, fp: BinaryIO, magic: int, table: list[MPKEntry], sources: Mapping[bytes, Source], jobs: Optional[int] = None, stop: Optional[threading.Event] = None):
+        # table为plan排布好的记录表：先把文件扩展到最终大小并写入记录表，再由多个线程把数据写到各自的位置
+        # 结果与dump逐个写入的相同；jobs为1时按顺序写入
+        header = BytesIO()
+        with BufferedWriter(header) as data: cls.dump_table(data, magic, table)
+        positions = {(entry.offset, entry.size, entry.name) for entry in table} # 重复的记录只写一次
+        end = max((offset + size for offset, size, _ in positions), default=0)
+        with stats.stage('mpk.assemble'):
+            preallocate(fp, max(end, header.tell()))
+            pwrite(fp, header.getbuffer(), 0)
+            writes = [(fp, offset, size, sources[name], stop) for offset, size, name in sorted(positions)]
+            if jobs == 1:
+                for args in writes: write_source(*args)
+            else:
+                with ThreadPoolExecutor(jobs) as pool:
+                    for _ in pool.map(write_source, *zip(*writes)): pass
+
+    def prepare(self, follow_given_order: bool = False, policy: Optional[Policy] = None, jobs: Optional[int] = None):
+        # policy按记录名决定压缩方式，不给出时沿用读入时的压缩方式
+        # 返回排布好的记录表与各记录要写入的数据
+        data_order = list(self.data_dump_order(follow_given_order))
+        methods = [self.compression_of(name, policy) for name in data_order]
+        with stats.stage('mpk.dump.compress'):
+            stored = compression.compress_many([(method, self.entries[name]) for name, method in zip(data_order, methods)], jobs)
+        payloads = dict(zip(data_order, stored))
+        table = self.plan(
+            self.entry_dump_order(follow_given_order),
+            ((name, len(payloads[name])) for name in data_order),
+        )
+        method_of = dict(zip(data_order, methods))
+        for entry in table:
+            entry.compression = method_of[entry.name]
+            entry.also_size = len(self.entries[entry.name])
+        return table, payloads
+
+    def dump(self, data: Writable, follow_given_order: bool = False, policy: Optional[Policy] = None, jobs: Optional[int] = None):
+        table, payloads = self.prepare(follow_given_order, policy, jobs)
+        self.dump_table(data, self.magic, table)
+        with stats.stage('mpk.dump.data'):
+            # 写入记录数据
+            for entry in sorted(table, key=lambda e: e.offset):
+                data.pad_until(entry.offset)
+                data.write(payloads[entry.name])
+
+    @classmethod
+    def read(cls, path: str | Path, jobs: Optional[int] = None):
+        with MMapReader.open(path) as data:
+            return cls.load(data, jobs)
 
     @classmethod
-    def read(cls, path: str | Path):
-        with open(path, 'rb') as fp:
-            return cls.load(FileWrapper(fp))
+    async def aread(cls, path: str | Path, runner: AsyncRunner = DEFAULT_RUNNER):
+        return await runner.run(cls.read, path)
 
-    def write(self, path: str | Path):
-        with open(path, 'wb') as fp:
-            self.dump(FileWrapper(fp))
+    def write(self, path: str | Path, policy: Optional[Policy] = None, jobs: Optional[int] = None):
+        # jobs大于1时压缩与写入都并行进行
+        if jobs is not None and jobs > 1:
+            table, payloads = self.prepare(policy=policy, jobs=jobs)
+            with open(path, 'wb') as fp: self.assemble(fp, self.magic, table, payloads, jobs)
+        else:
+            with open(path, 'wb') as fp, BufferedWriter(fp) as data:
+                self.dump(data, policy=policy, jobs=jobs)
@@ -0,0 +1,74 @@
+from typing import ByteString, Optional, Iterator
+from pathlib import Path
+from mages_tools.errors import *
+from mages_tools.io import *
+from .layout import MPKLayout, MPKEntry
+from . import compression
+
+# 只解析文件头与记录表，记录数据在访问时才以memoryview切片的形式给出，压缩的记录在访问时解压
+# 通过open打开时底层为MMapReader，close时若切片仍被引用，mmap会等切片全部释放后再关闭
+class LazyMPKLayout:
+    magic: int
+    table: list[MPKEntry]
+    index: dict[bytes, MPKEntry]
+    _view: memoryview
+    _reader: Optional[MMapReader]
+
+    def __init__(self, buf: ByteString, reader: Optional[MMapReader] = None):
+        self.magic, self.table = MPKLayout.load_table(ROBuffer(buf))
+        # 同名记录以数据靠后的为准，与MPKLayout.load一致；迭代顺序仍按记录表
+        latest = {entry.name: entry for entry in sorted(self.table, key=lambda e: e.offset)}
+        self.index = {entry.name: latest[entry.name] for entry in self.table}
+        self._view = memoryview(buf)
+        self._reader = reader
+
+    @classmethod
+    def open(cls, path: str | Path):
+        reader = MMapReader.open(path)
+        try: return cls(reader.buf, reader)
+        except BaseException:
+            reader.close(); raise
+
+    def close(self):
+        self._view.release()
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def __enter__(self): return self
+
+    def __exit__(self, *exc): self.close()
+
+    def __len__(self): return len(self.index)
+
+    def __iter__(self) -> Iterator[bytes]: return iter(self.index)
+
+    def __contains__(self, name: bytes): return name in self.index
+
+    def __getitem__(self, name: bytes): return self.read(name)
+
+    def view(self, name: bytes) -> memoryview:
+        # 存储的原始数据，压缩的记录不解压
+        entry = self.index[name]
+        if entry.offset + entry.size > len(self._view):
+            raise InvalidDataError(f"entry {repr(name)} out of range")
+        return self._view[entry.offset:entry.offset + entry.size]
+
+    def read(self, name: bytes) -> ByteString:
+        entry = self.index[name]
+        return compression.decompress(entry.compression, self.view(name), entry.also_size)
+
+    def reader(self, name: bytes):
+        return ROBuffer(self.read(name))
+
+    def to_layout(self):
+        entry_order = [(entry.name, entry.index) for entry in self.table]
+        data_order = [entry.name for entry in sorted(self.table, key=lambda e: e.offset)]
+        methods = {entry.name: entry.compression for entry in self.table if entry.compression != compression.NONE}
+        return MPKLayout(
+            entries={name: bytes(self.read(name)) for name in data_order},
+            magic=self.magic,
+            entry_order=entry_order,
+            data_order=data_order,
+            compression=methods or None,
+        )
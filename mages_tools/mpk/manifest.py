@@ -0,0 +1,63 @@
+from pathlib import Path
+from typing import Optional
+from dataclasses import dataclass, asdict
+import hashlib
+import json
+from mages_tools.io import COPY_CHUNK_SIZE
+
+def new_hash():
+    return hashlib.blake2b(digest_size=16)
+
+def file_hash(path: Path):
+    hasher = new_hash()
+    with open(path, 'rb') as fp:
+        while chunk := fp.read(COPY_CHUNK_SIZE): hasher.update(chunk)
+    return hasher.hexdigest()
+
+@dataclass(slots=True)
+class ManifestEntry:
+    offset: int # 在archive中的位置
+    size: int # 解包出的文件的大小
+    mtime_ns: int # 解包出的文件的修改时间
+    hash: str
+    compression: int = 0 # 在archive中的压缩方式，重新打包时沿用
+    stored_size: Optional[int] = None # 在archive中存储的大小，未压缩时为None
+
+@dataclass(slots=True)
+class Manifest:
+    archive: str # 记录中的数据所在的MPK文件
+    archive_size: int
+    archive_mtime_ns: int
+    magic: int
+    entries: dict[str, ManifestEntry]
+
+    @staticmethod
+    def path_for(basedir: Path):
+        # 清单放在解包目录旁边，以免被当作记录打包
+        return basedir.with_name(basedir.name + '.manifest.json')
+
+    def archive_unchanged(self):
+        try: stat = Path(self.archive).stat()
+        except FileNotFoundError: return False
+        return stat.st_size == self.archive_size and stat.st_mtime_ns == self.archive_mtime_ns
+
+    def entry_unchanged(self, name: str, path: Path):
+        # 大小与修改时间一致即视为未修改，只有修改时间变了才计算哈希
+        entry = self.entries.get(name)
+        if entry is None: return False
+        stat = path.stat()
+        if stat.st_size != entry.size: return False
+        if stat.st_mtime_ns == entry.mtime_ns: return True
+        if file_hash(path) != entry.hash: return False
+        entry.mtime_ns = stat.st_mtime_ns
+        return True
+
+    @classmethod
+    def read(cls, path: Path) -> Optional['Manifest']:
+        try: raw = json.loads(path.read_text(encoding='utf-8'))
+        except FileNotFoundError: return None
+        raw['entries'] = {name: ManifestEntry(**entry) for name, entry in raw['entries'].items()}
+        return cls(**raw)
+
+    def write(self, path: Path):
+        path.write_text(json.dumps(asdict(self), ensure_ascii=False, indent=1), encoding='utf-8')
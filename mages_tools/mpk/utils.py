@@ -1,23 +1,290 @@
 from pathlib import Path
-from .layout import MPKLayout, FileWrapper
+from typing import BinaryIO, ByteString, Mapping, Optional
+from contextlib import nullcontext
+from collections import deque
+from io import BytesIO
+import os
+import threading
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from mages_tools.errors import *
+from mages_tools import stats
+from mages_tools.io import COPY_CHUNK_SIZE
+from .layout import MPKLayout, MPKEntry, Writable, FileWrapper, BufferedWriter, pread, pwrite, write_source
+from .lazy import LazyMPKLayout
+from .manifest import Manifest, ManifestEntry, new_hash, file_hash
+from . import compression
+from .compression import Policy
 
-def unpack(src: Path, dst: Path):
+def read_stored(fp: BinaryIO, entry: MPKEntry, offset: int, size: int):
+    chunk = pread(fp, size, entry.offset + offset)
+    if len(chunk) != size: raise InvalidDataError(f"entry {repr(entry.name)} out of range")
+    return chunk
+
+def extract_entry(fp: BinaryIO, entry: MPKEntry, path: Path, digest: bool = False) -> Optional[ManifestEntry]:
+    # 按记录位置定位读取，不依赖也不改变fp的当前位置；压缩的记录整体读入后解压
+    hasher = new_hash() if digest else None
+    with open(path, 'wb') as out:
+        data = FileWrapper(out) # 经由FileWrapper写出，计入io.write
+        if entry.compression != compression.NONE:
+            chunk = compression.decompress(entry.compression, read_stored(fp, entry, 0, entry.size), entry.also_size)
+            data.write(chunk)
+            if hasher is not None: hasher.update(chunk)
+        else:
+            for done in range(0, entry.size, COPY_CHUNK_SIZE):
+                chunk = read_stored(fp, entry, done, min(COPY_CHUNK_SIZE, entry.size - done))
+                data.write(chunk)
+                if hasher is not None: hasher.update(chunk)
+    if hasher is None: return None
+    stored_size = None if entry.compression == compression.NONE else entry.size
+    return ManifestEntry(entry.offset, entry.also_size, path.stat().st_mtime_ns, hasher.hexdigest(), entry.compression, stored_size)
+
+def unpack(src: Path, dst: Path, jobs: int = 1, manifest: bool = False):
     if not (src.is_file() and dst.is_dir()):
         raise ValueError('invalid path')
+    if jobs < 1: raise ValueError('invalid job count')
     with open(src, 'rb') as fp:
-        pkg = MPKLayout.load(FileWrapper(fp))
-    basedir = dst / src.stem
-    basedir.mkdir(exist_ok=True)
-    for name, data in pkg.entries.items():
-        (basedir / name.decode()).write_bytes(data)
+        magic, table = MPKLayout.load_table(FileWrapper(fp))
+        # 同名记录以数据靠后的为准
+        entries = {entry.name: entry for entry in sorted(table, key=lambda e: e.offset)}
+        basedir = dst / src.stem
+        basedir.mkdir(exist_ok=True)
+        with stats.stage('mpk.unpack.extract'):
+            if jobs == 1:
+                results = [
+                    extract_entry(fp, entry, basedir / name.decode(), manifest)
+                    for name, entry in entries.items()
+                ]
+            else:
+                with ThreadPoolExecutor(jobs) as pool:
+                    futures = [
+                        pool.submit(extract_entry, fp, entry, basedir / name.decode(), manifest)
+                        for name, entry in entries.items()
+                    ]
+                    results = [future.result() for future in futures]
+        stats.count('mpk.unpack.entries', len(entries))
+    if manifest: write_unpack_manifest(src, basedir, magic, list(entries), results)
 
-def repack(src: Path, dst: Path):
+def write_unpack_manifest(src: Path, basedir: Path, magic: int, names: list[bytes], results: list[ManifestEntry]):
+    stat = src.stat()
+    Manifest(
+        archive=str(src.resolve()),
+        archive_size=stat.st_size,
+        archive_mtime_ns=stat.st_mtime_ns,
+        magic=magic,
+        entries={name.decode(): result for name, result in zip(names, results)},
+    ).write(Manifest.path_for(basedir))
+
+def repack(src: Path, dst: Path, manifest: bool = False, stop: Optional[threading.Event] = None, policy: Optional[Policy] = None, jobs: Optional[int] = None):
     if not (src.is_dir() and dst.is_dir()):
         raise ValueError('invalid path')
-    entries = dict[bytes, bytes]()
-    for sub in src.iterdir():
-        entries[sub.name.encode()] = sub.read_bytes()
-    pkg = MPKLayout(entries=entries)
-    filename = src.name + '.mpk'
-    with open(dst / filename, 'wb') as fp:
-        pkg.dump(FileWrapper(fp))
+    # 只用文件大小排布记录，未压缩的数据从源文件直接复制到输出，不在内存中保留
+    files = {sub.name.encode(): sub for sub in src.iterdir()}
+    names = sorted(files)
+    out_path = dst / (src.name + '.mpk')
+    # 有清单时，未修改的记录直接从上次的MPK中复制
+    recorded = Manifest.read(Manifest.path_for(src)) if manifest else None
+    info = recorded if recorded is not None and recorded.archive_unchanged() else None
+    # 压缩方式：policy优先，其次沿用清单中记录的方式
+    methods = dict[bytes, int]()
+    for name in names:
+        if policy is not None: methods[name] = policy(name)
+        elif recorded is not None and (rec := recorded.entries.get(name.decode())) is not None: methods[name] = rec.compression
+        else: methods[name] = compression.NONE
+    unchanged = set[bytes]()
+    if info is not None:
+        with stats.stage('mpk.repack.check'):
+            unchanged = {
+                name for name in names
+                if info.entry_unchanged(name.decode(), files[name]) and info.entries[name.decode()].compression == methods[name]
+            }
+        stats.count('mpk.repack.unchanged', len(unchanged))
+        if len(unchanged) == len(names) == len(info.entries) and Path(info.archive) == out_path.resolve():
+            info.write(Manifest.path_for(src)) # 只更新修改时间
+            stats.count('mpk.repack.skipped')
+            return
+    magic = MPKLayout.DEFAULT_MAGIC if info is None else info.magic
+    sizes = {name: files[name].stat().st_size for name in names}
+    # 需要重新压缩的记录在写到它时才读入并压缩：按数据顺序提交给线程池，只有窗口内的几条留在内存中
+    # 压缩后的大小事先未知，因此按数据顺序边写边计算位置，最后再写入记录表
+    to_compress = [name for name in names if methods[name] != compression.NONE and name not in unchanged]
+    compressed = compression.map_ordered(lambda method, path: compression.compress(method, path.read_bytes()), ((methods[name], files[name]) for name in to_compress), jobs)
+    # 输出可能就是上次的MPK，先写到临时文件
+    # stop被设置时在记录之间中止，不留下不完整的输出
+    tmp_path = out_path.with_name(out_path.name + '.tmp')
+    stored_sizes = dict[bytes, int]()
+    parallel = jobs is not None and jobs > 1
+    try:
+        with open(tmp_path, 'wb') as fp, (nullcontext() if info is None else open(info.archive, 'rb')) as orig_fp, \
+                (ThreadPoolExecutor(jobs) if parallel else nullcontext()) as pool, \
+                (nullcontext() if parallel else BufferedWriter(fp)) as data, stats.stage('mpk.repack.copy'):
+            # 多个线程时按算好的位置并行写入，未完成的写入最多为线程数的两倍
+            pending = deque()
+            offset = MPKLayout.data_start(len(names))
+            for name in names:
+                if stop is not None and stop.is_set(): raise InterruptedError('repack cancelled')
+                if name in unchanged:
+                    size = info.entries[name.decode()].stored_size or sizes[name]
+                    source = (orig_fp, info.entries[name.decode()].offset)
+                elif methods[name] != compression.NONE:
+                    source = next(compressed)
+                    size = len(source)
+                else:
+                    size = sizes[name]
+                    source = files[name]
+                stored_sizes[name] = size
+                if parallel:
+                    pending.append(pool.submit(write_source, fp, offset, size, source, stop))
+                    if len(pending) > 2 * jobs: pending.popleft().result()
+                else:
+                    data.pad_until(offset)
+                    if isinstance(source, tuple): data.write_from(source[0], size, source[1])
+                    else: write_payload(data, source)
+                offset = MPKLayout.next_aligned(offset + size)
+            for future in pending: future.result()
+            table = MPKLayout.plan(zip(names, range(len(names))), stored_sizes.items())
+            for entry in table:
+                entry.compression = methods[entry.name]
+                entry.also_size = sizes[entry.name]
+            if parallel:
+                header = BytesIO()
+                with BufferedWriter(header) as header_data: MPKLayout.dump_table(header_data, magic, table)
+                pwrite(fp, header.getbuffer(), 0)
+                fp.truncate(max([entry.offset + entry.size for entry in table] + [header.tell()]))
+            else:
+                data.seek(0)
+                MPKLayout.dump_table(data, magic, table)
+    except BaseException:
+        compressed.close()
+        tmp_path.unlink(missing_ok=True); raise
+    os.replace(tmp_path, out_path)
+    if manifest:
+        entries = dict[str, ManifestEntry]()
+        for entry in table:
+            name = entry.name.decode()
+            digest = info.entries[name].hash if entry.name in unchanged else file_hash(files[entry.name])
+            stored = None if entry.compression == compression.NONE else entry.size
+            entries[name] = ManifestEntry(entry.offset, entry.also_size, files[entry.name].stat().st_mtime_ns, digest, entry.compression, stored)
+        stat = out_path.stat()
+        Manifest(
+            archive=str(out_path.resolve()),
+            archive_size=stat.st_size,
+            archive_mtime_ns=stat.st_mtime_ns,
+            magic=magic,
+            entries=entries,
+        ).write(Manifest.path_for(src))
+
+def write_payload(data: Writable, payload: bytes | Path):
+    if isinstance(payload, Path):
+        with open(payload, 'rb') as src_fp:
+            data.write_from(src_fp, payload.stat().st_size)
+    else: data.write(payload)
+
+def update(path: Path, replaces: Mapping[bytes, bytes | Path]):
+    # 原地替换记录：新数据放得进原先的对齐槽位就直接覆盖，否则追加到文件末尾，再改写记录表
+    with open(path, 'r+b') as fp:
+        data = FileWrapper(fp)
+        magic, table = MPKLayout.load_table(data)
+        file_size = data.size()
+        by_offset = sorted(range(len(table)), key=lambda i: table[i].offset)
+        # 大小为0的记录与下一条数据的位置相同，既不算占用空间，也没有可用的空间
+        starts = sorted((table[i].offset, i) for i in by_offset if table[i].size > 0)
+        start_offsets = [offset for offset, _ in starts]
+        # 每条记录可用的空间：对齐后的大小，且不能覆盖下一条数据（同位置的其他数据也算）
+        # 数据末尾最靠后的记录（last）不受限制
+        capacity = dict[int, int]()
+        for idx, entry in enumerate(table):
+            if entry.size == 0:
+                capacity[idx] = 0
+                continue
+            pos = bisect_left(start_offsets, entry.offset)
+            if pos < len(starts) and starts[pos][1] == idx: pos += 1
+            limit = MPKLayout.next_aligned(entry.offset + entry.size)
+            if pos < len(starts): limit = min(limit, start_offsets[pos])
+            capacity[idx] = limit - entry.offset
+        last = max((i for _, i in starts), key=lambda i: table[i].offset + table[i].size, default=None)
+        index = {table[i].name: i for i in by_offset}
+        for name, payload in replaces.items():
+            # 原先压缩的记录按原方式重新压缩
+            raw_size = size = payload.stat().st_size if isinstance(payload, Path) else len(payload)
+            method = table[index[name]].compression if name in index else compression.NONE
+            if method != compression.NONE:
+                payload = compression.compress(method, payload.read_bytes() if isinstance(payload, Path) else payload)
+                size = len(payload)
+            if name in index:
+                idx = index[name]; entry = table[idx]
+                if idx == last or size <= capacity[idx]:
+                    data.seek(entry.offset)
+                    write_payload(data, payload)
+                    if idx == last: # 文件随最后一条记录伸缩，但不能截掉大小为0的记录所在的位置
+                        file_size = max(entry.offset + size, max(e.offset for e in table))
+                        fp.truncate(file_size)
+                        if size == 0: last = None # 大小为0的记录不能作为last
+                    elif size < entry.size: data.pad(entry.size - size) # 清除旧数据残留
+                    entry.size = size; entry.also_size = raw_size
+                    continue
+            else:
+                # 新记录需要记录表与第一条数据之间留有空位
+                if 0x40 + MPKLayout.ENTRY_SIZE * (len(table) + 1) > table[by_offset[0]].offset:
+                    raise InvalidDataError(f"no room for new entry {repr(name)}, repack instead")
+                if len(name) + 1 > MPKLayout.ENTRY_NAME_MAX_SIZE:
+                    raise InvalidDataError(f"entry name {repr(name)} too long")
+                idx = len(table)
+                table.append(MPKEntry(name, idx, 0, 0, 0))
+                index[name] = idx
+            # 追加到文件末尾，原先的最后一条记录从此只能用到对齐边界
+            entry = table[idx]
+            if last is not None: capacity[last] = MPKLayout.next_aligned(file_size) - table[last].offset
+            entry.offset = MPKLayout.next_aligned(file_size)
+            entry.size = size; entry.also_size = raw_size
+            capacity[idx] = 0
+            if size > 0: last = idx
+            data.seek(file_size)
+            data.pad_until(entry.offset)
+            write_payload(data, payload)
+            file_size = entry.offset + size
+        # 改写记录表
+        data.seek(0)
+        MPKLayout.dump_table(data, magic, table)
+
+def same_content(path: Path, data: ByteString):
+    with open(path, 'rb') as fp:
+        view = memoryview(data).cast('B')
+        for done in range(0, len(view), COPY_CHUNK_SIZE):
+            if fp.read(COPY_CHUNK_SIZE) != view[done:done + COPY_CHUNK_SIZE]: return False
+        return fp.read(1) == b''
+
+def changed_files(src: Path, archive: Path, manifest: bool = False) -> dict[bytes, Path]:
+    # 找出src中与archive里的记录不同（或archive中没有）的文件，用于update
+    # 有与archive相符的清单时按大小与修改时间判断，否则先比较大小，大小相同再比较内容
+    files = {sub.name.encode(): sub for sub in src.iterdir()}
+    recorded = Manifest.read(Manifest.path_for(src)) if manifest else None
+    if recorded is not None and recorded.archive_unchanged() and Path(recorded.archive) == archive.resolve():
+        return {name: path for name, path in files.items() if not recorded.entry_unchanged(name.decode(), path)}
+    changed = dict[bytes, Path]()
+    with LazyMPKLayout.open(archive) as layout, stats.stage('mpk.update.check'):
+        for name, path in files.items():
+            if name not in layout or layout.index[name].also_size != path.stat().st_size or not same_content(path, layout.read(name)):
+                changed[name] = path
+    stats.count('mpk.update.unchanged', len(files) - len(changed))
+    return changed
+
+def compact(path: Path):
+    # 按原有顺序重新紧凑排布数据，去除update追加后留下的空洞
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(path, 'rb') as fp:
+        magic, table = MPKLayout.load_table(FileWrapper(fp))
+        data_order = sorted(table, key=lambda e: e.offset)
+        new_table = MPKLayout.plan(
+            ((entry.name, entry.index) for entry in table),
+            ((entry.name, entry.size) for entry in data_order),
+        )
+        for old, new in zip(table, new_table):
+            new.compression = old.compression
+            new.also_size = old.also_size
+        with open(tmp_path, 'wb') as out, BufferedWriter(out) as data:
+            MPKLayout.dump_table(data, magic, new_table)
+            for old, new in zip(data_order, sorted(new_table, key=lambda e: e.offset)):
+                data.pad_until(new.offset)
+                data.write_from(fp, old.size, old.offset)
+    os.replace(tmp_path, path)
@@ -1,3 +1,9 @@
 from .layout import SCXLayout as Layout
-from .tokenizer import TokenType, tokenize, untokenize, tokenize_from_buffer, untokenize_to_buffer
+from .tokenizer import TokenType, tokenize, untokenize, tokenize_from_buffer, untokenize_to_buffer, tokenize_many, untokenize_many
 from .codec import SCXCodec as Codec, DEFAULT_CODEC
+from .compact import TokenStream
+from .cache import TokenCache
+from .lazy import LazySCXLayout as LazyLayout
+from .xref import SCXXref as Xref, XrefScanner, PatternScanner
+from .diff import StringDiff, diff_files
+from .charsets import CharsetRegistry, charsets
@@ -0,0 +1,64 @@
+from pathlib import Path
+from typing import Optional
+from mages_tools.scx.bulk import export_strings, import_strings
+from mages_tools.scx.xref import SCXXref, PatternScanner
+from mages_tools.scx.diff import diff_files
+from mages_tools.scx.charsets import charsets, write_charset
+
+import click
+
+@click.group()
+def cli():
+    pass
+
+@cli.command('export')
+@click.argument('src')
+@click.argument('out')
+@click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']), default=None, help='table format, guessed from OUT by default')
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=None, help='number of worker processes')
+@click.option('--cache-size', type=click.IntRange(min=0), default=0, help='per-worker cache of repeated strings, 0 to disable')
+@click.option('--charset', default='default', help='registered charset name or path to a compiled charset table')
+def export_cmd(src: str, out: str, fmt: Optional[str], jobs: Optional[int], cache_size: int, charset: str):
+    export_strings(Path(src), Path(out), fmt, jobs, cache_size=cache_size, charset=charset)
+
+@cli.command('import')
+@click.argument('src')
+@click.argument('table')
+@click.argument('dst')
+@click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']), default=None, help='table format, guessed from TABLE by default')
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=None, help='number of worker processes')
+@click.option('--cache-size', type=click.IntRange(min=0), default=0, help='per-worker cache of repeated strings, 0 to disable')
+@click.option('--charset', default='default', help='registered charset name or path to a compiled charset table')
+def import_cmd(src: str, table: str, dst: str, fmt: Optional[str], jobs: Optional[int], cache_size: int, charset: str):
+    import_strings(Path(src), Path(table), Path(dst), fmt, jobs, cache_size=cache_size, charset=charset)
+
+@cli.command()
+@click.argument('scx')
+@click.option('--opcode', required=True, help='hex bytes of the instruction that references a string')
+@click.option('--index-format', default='<H', help='struct format of the string index after the opcode')
+@click.option('--skip', type=click.IntRange(min=0), default=0, help='bytes between the opcode and the string index')
+@click.option('--string', 'strings', type=int, multiple=True, help='list references of this string (repeatable)')
+@click.option('--label', 'labels', type=int, multiple=True, help='list strings used by this label (repeatable)')
+def xref(scx: str, opcode: str, index_format: str, skip: int, strings: tuple[int, ...], labels: tuple[int, ...]):
+    index = SCXXref.cached(Path(scx), PatternScanner(bytes.fromhex(opcode), index_format, skip))
+    for stridx in strings:
+        for addr, label in index.refs_of_string(stridx):
+            click.echo(f'string {stridx}\t{addr:#x}\tlabel {label}')
+    for label in labels:
+        click.echo(f'label {label}\t' + ' '.join(map(str, index.strings_of_label(label))))
+
+@cli.command('diff')
+@click.argument('old')
+@click.argument('new')
+def diff_cmd(old: str, new: str):
+    result = diff_files(Path(old), Path(new))
+    for mark, indices in (('A', result.added), ('D', result.removed), ('M', result.modified)):
+        for stridx in indices: click.echo(f'{mark} string {stridx}')
+
+@cli.command('compile-charset')
+@click.argument('name')
+@click.argument('out')
+def compile_charset(name: str, out: str):
+    write_charset(Path(out), charsets.resolve(name).charset)
+
+cli()
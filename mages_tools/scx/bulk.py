@@ -0,0 +1,103 @@
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, TextIO
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import json
+from .layout import SCXLayout
+from .tokenizer import TokenType, SCXToken, BareToken, UnaryToken, ExpressionToken, registry, tokenize_many
+from .cache import TokenCache
+from .codec import SCXCodec, DEFAULT_CODEC
+from .charsets import charsets
+
+# 导出表中的一行：(文件相对路径, 字符串序号, 词法单元)
+Record = tuple[str, int, list[str | SCXToken]]
+
+# 每个工作进程各自的缓存与字符集，由init_worker设置
+worker_cache: Optional[TokenCache] = None
+worker_codec: SCXCodec = DEFAULT_CODEC
+
+def init_worker(cache_size: int, charset: str = 'default'):
+    global worker_cache, worker_codec
+    worker_cache = TokenCache(cache_size) if cache_size > 0 else None
+    worker_codec = charsets.resolve(charset)
+
+def token_to_json(token: str | SCXToken):
+    if isinstance(token, str): return token
+    if isinstance(token, UnaryToken): return {'type': token.type.name, 'arg': token.arg}
+    if isinstance(token, ExpressionToken):
+        return {'type': token.type.name, 'args': [[ctrl, bytes(expr).hex()] for ctrl, expr in token.args]}
+    return {'type': token.type.name}
+
+def token_from_json(obj: str | dict) -> str | SCXToken:
+    if isinstance(obj, str): return obj
+    typ = TokenType[obj['type']]
+    cls = registry[typ]
+    if cls is UnaryToken: return UnaryToken(typ, obj['arg'])
+    if cls is ExpressionToken: return ExpressionToken(typ, [(ctrl, bytes.fromhex(expr)) for ctrl, expr in obj['args']])
+    return BareToken(typ)
+
+def write_records(fp: TextIO, records: Iterable[Record], fmt: str):
+    writer = csv.writer(fp) if fmt == 'csv' else None
+    for file, index, tokens in records:
+        tokens_json = [token_to_json(token) for token in tokens]
+        if writer is None:
+            fp.write(json.dumps({'file': file, 'index': index, 'tokens': tokens_json}, ensure_ascii=False) + '\n')
+        else:
+            writer.writerow([file, index, json.dumps(tokens_json, ensure_ascii=False)])
+
+def read_records(fp: TextIO, fmt: str) -> Iterator[Record]:
+    if fmt == 'csv':
+        for file, index, tokens_json in csv.reader(fp):
+            yield file, int(index), [token_from_json(obj) for obj in json.loads(tokens_json)]
+    else:
+        for line in fp:
+            if not line.strip(): continue
+            obj = json.loads(line)
+            yield obj['file'], obj['index'], [token_from_json(token) for token in obj['tokens']]
+
+def guess_format(path: Path):
+    return 'csv' if path.suffix.lower() == '.csv' else 'jsonl'
+
+def export_file(path: Path, name: str) -> list[Record]:
+    layout = SCXLayout.read(path)
+    if worker_cache is None: token_lists = tokenize_many(layout.strings_raw, worker_codec)
+    else: token_lists = [list(tokens) for tokens in worker_cache.tokenize_many(layout.strings_raw, worker_codec)]
+    return [(name, index, tokens) for index, tokens in enumerate(token_lists)]
+
+def import_file(src: Path, dst: Path, replaces: dict[int, list[str | SCXToken]]):
+    layout = SCXLayout.read(src)
+    layout.rewrite(replaces, worker_codec, worker_cache)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    layout.write(dst, follow_given_order=True) # 保持原文件中字符串数据的顺序
+
+def map_files(func, jobs: Optional[int], cache_size: int, charset: str, *iterables):
+    # 结果按提交顺序返回，保证输出顺序确定；字符集以名称传给工作进程，各自从登记处取得
+    if jobs == 1:
+        init_worker(cache_size, charset)
+        try: yield from map(func, *iterables)
+        finally: init_worker(0)
+    else:
+        with ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(cache_size, charset)) as pool:
+            yield from pool.map(func, *iterables, chunksize=4)
+
+def export_strings(src: Path, out: Path, fmt: Optional[str] = None, jobs: Optional[int] = None, pattern: str = '*.scx', cache_size: int = 0, charset: str = 'default'):
+    if not src.is_dir(): raise ValueError('invalid path')
+    fmt = fmt or guess_format(out)
+    charsets.resolve(charset) # 在启动工作进程前检查字符集
+    files = sorted(src.rglob(pattern))
+    names = [path.relative_to(src).as_posix() for path in files]
+    with open(out, 'w', encoding='utf-8', newline='') as fp:
+        for records in map_files(export_file, jobs, cache_size, charset, files, names):
+            write_records(fp, records, fmt)
+
+def import_strings(src: Path, table: Path, dst: Path, fmt: Optional[str] = None, jobs: Optional[int] = None, cache_size: int = 0, charset: str = 'default'):
+    if not (src.is_dir() and table.is_file()): raise ValueError('invalid path')
+    fmt = fmt or guess_format(table)
+    charsets.resolve(charset)
+    replaces = dict[str, dict[int, list[str | SCXToken]]]()
+    with open(table, 'r', encoding='utf-8', newline='') as fp:
+        for file, index, tokens in read_records(fp, fmt):
+            replaces.setdefault(file, {})[index] = tokens
+    names = sorted(replaces)
+    for _ in map_files(import_file, jobs, cache_size, charset, [src / name for name in names], [dst / name for name in names], [replaces[name] for name in names]):
+        pass
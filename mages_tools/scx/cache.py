@@ -0,0 +1,88 @@
+from typing import ByteString, Iterable, Callable, Hashable
+from collections import OrderedDict
+from dataclasses import dataclass
+from array import array
+import threading
+from .codec import SCXCodec, DEFAULT_CODEC
+from .tokenizer import SCXToken, tokenize_from_buffer, untokenize_to_buffer, tokenize_many, untokenize_many
+
+@dataclass(slots=True)
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+class TokenCache:
+    # 以原始字节（或词法单元元组）加编解码函数为键的LRU缓存
+    # 缓存的词法单元在多处共享，取出后不应修改
+    maxsize: int
+    stats: CacheStats
+    _data: OrderedDict[Hashable, tuple[str | SCXToken, ...] | bytes]
+    _lock: threading.Lock
+
+    def __init__(self, maxsize: int = 1 << 16):
+        if maxsize <= 0: raise ValueError('invalid cache size')
+        self.maxsize = maxsize
+        self.stats = CacheStats()
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self): return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.stats = CacheStats()
+
+    def _get(self, key: Hashable):
+        with self._lock:
+            result = self._data.get(key)
+            if result is None: self.stats.misses += 1
+            else:
+                self.stats.hits += 1
+                self._data.move_to_end(key)
+            return result
+
+    def _put(self, key: Hashable, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.stats.evictions += 1
+
+    def tokenize(self, strn: ByteString, decoder: Callable[['array[int]'], str] = DEFAULT_CODEC.decode):
+        key = ('tokenize', decoder, bytes(strn))
+        if (result := self._get(key)) is None:
+            result = tuple(tokenize_from_buffer(strn, decoder))
+            self._put(key, result)
+        return result
+
+    def untokenize(self, tokens: Iterable[str | SCXToken], encoder: Callable[[str], Iterable[int]] = DEFAULT_CODEC.encode):
+        tokens = tuple(tokens)
+        key = ('untokenize', encoder, tokens)
+        if (result := self._get(key)) is None:
+            result = untokenize_to_buffer(tokens, encoder)
+            self._put(key, result)
+        return result
+
+    def tokenize_many(self, strings: Iterable[ByteString], codec: SCXCodec = DEFAULT_CODEC):
+        # 只把未命中且互不相同的字符串交给批量接口
+        keys = [('tokenize', codec.decode, bytes(strn)) for strn in strings]
+        results = [self._get(key) for key in keys]
+        missing = list(dict.fromkeys(key for key, result in zip(keys, results) if result is None))
+        decoded = dict[Hashable, tuple[str | SCXToken, ...]]()
+        for key, tokens in zip(missing, tokenize_many((key[2] for key in missing), codec)):
+            decoded[key] = tuple(tokens)
+            self._put(key, decoded[key])
+        return [decoded[key] if result is None else result for key, result in zip(keys, results)]
+
+    def untokenize_many(self, token_lists: Iterable[Iterable[str | SCXToken]], codec: SCXCodec = DEFAULT_CODEC):
+        keys = [('untokenize', codec.encode, tuple(tokens)) for tokens in token_lists]
+        results = [self._get(key) for key in keys]
+        missing = list(dict.fromkeys(key for key, result in zip(keys, results) if result is None))
+        encoded = dict[Hashable, bytes]()
+        for key, strn in zip(missing, untokenize_many((key[2] for key in missing), codec)):
+            encoded[key] = strn
+            self._put(key, strn)
+        return [encoded[key] if result is None else result for key, result in zip(keys, results)]
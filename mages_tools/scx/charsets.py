@@ -0,0 +1,139 @@
+from typing import ByteString, Optional, Iterable
+from pathlib import Path
+from dataclasses import dataclass
+from functools import partial
+import hashlib
+import os
+import struct
+import threading
+from mages_tools.errors import *
+from mages_tools.io import *
+from mages_tools import stats
+from .codec import SCXCodec, DEFAULT_CHARSET
+
+# 字符集表文件格式（小端序）：CHARSET_HEADER，随后是count个u16字符码与count个u32字符
+CHARSET_MAGIC = b'SCXC'
+CHARSET_VERSION = 1
+CHARSET_HEADER = struct.Struct('<4sII') # magic, version, count
+
+def dump_charset(charset: dict[int, int]) -> bytes:
+    codes = struct.pack(f'<{len(charset)}H', *charset.keys())
+    chars = struct.pack(f'<{len(charset)}I', *charset.values())
+    return CHARSET_HEADER.pack(CHARSET_MAGIC, CHARSET_VERSION, len(charset)) + codes + chars
+
+def load_charset(buf: ByteString) -> dict[int, int]:
+    view = memoryview(buf).cast('B')
+    try:
+        if len(view) < CHARSET_HEADER.size: raise InvalidDataError("charset header truncated")
+        magic, version, count = CHARSET_HEADER.unpack_from(view)
+        if magic != CHARSET_MAGIC: raise InvalidDataError("charset header mismatch")
+        if version != CHARSET_VERSION: raise InvalidDataError(f"unsupported charset version {version}")
+        codes_end = CHARSET_HEADER.size + 2 * count
+        if len(view) != codes_end + 4 * count: raise InvalidDataError("charset table size mismatch")
+        codes = struct.unpack_from(f'<{count}H', view, CHARSET_HEADER.size)
+        chars = struct.unpack_from(f'<{count}I', view, codes_end)
+        return dict(zip(codes, chars))
+    finally: view.release()
+
+def read_charset(path: str | Path):
+    with MMapReader.open(path) as data:
+        return load_charset(data.buf)
+
+def write_charset(path: str | Path, charset: dict[int, int]):
+    # 多个进程可能同时写入缓存，先写临时文件再替换
+    path = Path(path)
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    tmp_path.write_bytes(dump_charset(charset))
+    os.replace(tmp_path, path)
+
+@dataclass(slots=True, frozen=True)
+class CharsetSpec:
+    # 三者取其一：字符集字符串、字符集表文件、在另一个字符集上替换部分字符
+    string: Optional[str] = None
+    omit_char: str = '\0'
+    path: Optional[Path] = None
+    base: Optional[str] = None
+    replaces: tuple[tuple[str, str], ...] = ()
+
+    def cache_key(self):
+        return hashlib.blake2b(f'{self.string}\0{self.omit_char}'.encode('utf-8', 'surrogatepass'), digest_size=8).hexdigest()
+
+class CharsetRegistry:
+    # 按名称登记字符集，第一次使用时才构造codec，之后在进程内共用
+    # 派生的字符集沿用基础字符集的编解码表，只另外保存改动的字符（见SCXCodec.make_overlay）
+    # 由字符串定义的字符集在第一次编解码时才展开；给出cache_dir时编译成表文件缓存，其他进程直接映射读取
+    cache_dir: Optional[Path]
+    specs: dict[str, CharsetSpec]
+    _codecs: dict[str, SCXCodec]
+    _lock: threading.RLock
+
+    def __init__(self, cache_dir: Optional[Path] = None):
+        self.cache_dir = cache_dir
+        self.specs = dict[str, CharsetSpec]()
+        self._codecs = dict[str, SCXCodec]()
+        self._lock = threading.RLock()
+
+    def __contains__(self, name: str): return name in self.specs or name in self._codecs
+
+    def __iter__(self): return iter(self.specs.keys() | self._codecs.keys())
+
+    def _register(self, name: str, spec: CharsetSpec):
+        with self._lock:
+            self.specs[name] = spec
+            self._codecs.pop(name, None)
+
+    def register_string(self, name: str, charset: str, omit_char: str = '\0'):
+        self._register(name, CharsetSpec(string=charset, omit_char=omit_char))
+
+    def register_file(self, name: str, path: str | Path):
+        self._register(name, CharsetSpec(path=Path(path)))
+
+    def register_derived(self, name: str, base: str, replaces: Iterable[tuple[str, str]]):
+        self._register(name, CharsetSpec(base=base, replaces=tuple(replaces)))
+
+    def register_codec(self, name: str, codec: SCXCodec):
+        with self._lock:
+            self.specs.pop(name, None)
+            self._codecs[name] = codec
+
+    def get(self, name: str) -> SCXCodec:
+        with self._lock:
+            if (codec := self._codecs.get(name)) is None:
+                try: spec = self.specs[name]
+                except KeyError: raise KeyError(f'unknown charset {name}') from None
+                codec = self._codecs[name] = self._build(spec)
+            return codec
+
+    def _build(self, spec: CharsetSpec):
+        if spec.path is not None: return SCXCodec(read_charset(spec.path))
+        if spec.base is not None: return SCXCodec.base_on(self.get(spec.base), spec.replaces)
+        return SCXCodec.deferred(partial(self._compile, spec))
+
+    def _compile(self, spec: CharsetSpec) -> dict[int, int]:
+        if self.cache_dir is None: return SCXCodec.from_string(spec.string, spec.omit_char).charset
+        cache_path = self.cache_dir / f'{spec.cache_key()}.charset'
+        try:
+            charset = read_charset(cache_path)
+            stats.count('scx.charset.cache_hits')
+            return charset
+        except (FileNotFoundError, InvalidDataError): pass
+        charset = SCXCodec.from_string(spec.string, spec.omit_char).charset
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            write_charset(cache_path, charset)
+        except OSError: pass # 缓存目录不可写时不缓存
+        return charset
+
+    def resolve(self, name_or_path: str) -> SCXCodec:
+        # 未登记的名称当作字符集表文件的路径
+        if name_or_path not in self:
+            if not Path(name_or_path).is_file(): raise KeyError(f'unknown charset {name_or_path}')
+            self.register_file(name_or_path, name_or_path)
+        return self.get(name_or_path)
+
+def default_cache_dir():
+    if (path := os.environ.get('MAGES_TOOLS_CACHE')): return Path(path) / 'charsets'
+    return None
+
+charsets = CharsetRegistry(default_cache_dir())
+charsets.register_string('default', DEFAULT_CHARSET)
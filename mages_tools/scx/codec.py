@@ -1,12 +1,60 @@
-from typing import Iterable
+from typing import Callable, Iterable, Optional, Sequence
+from array import array
+from collections import Counter
+import sys
+import threading
+from mages_tools.errors import *
+
+# 本机字节序的UTF-16，用于在str与array('H')之间整体转换
+NATIVE_UTF16 = 'utf-16-le' if sys.byteorder == 'little' else 'utf-16-be'
+# SCX文本字符的高字节带有此位
+TEXT_BIT = 0x80
 
 class SCXCodec:
-    charset: dict[int, int]
-    _revmap: dict[int, int]
+    # 由deferred构造时，字符集在第一次使用时才取得
+    _charset: Optional[dict[int, int]]
+    _load: Optional[Callable[[], dict[int, int]]]
+    _reverse: Optional[dict[int, int]]
+    # 以字符码为下标的完整表，用于str.translate，第一次编解码时才生成
+    # 查不到的字符会被删除（超出表范围的则保持原样），再通过长度变化发现
+    _tables: Optional[tuple[list[int | None], list[int | None], list[int | None]]]
+    # 由base_on派生时不生成自己的表，而是沿用基础codec的表，在查表前后各用一个只含改动字符的小表替换：
+    #   编码前把受影响的字符换成基础codec中编码为目标字符码的字符（不再有对应字符码的删除）
+    #   解码后把被替换码位的旧字符换成新字符
+    # 旧字符在基础字符集中不唯一等无法这样对应的情况，退回到生成完整的表
+    _base: Optional['SCXCodec']
+    _changed_codes: tuple[int, ...]
+    _overlay: Optional[tuple[dict[int, int | None], dict[int, int]]] # (编码前, 解码后)
+    _prepared: bool
+    _prepare_lock: threading.Lock
+
+    def __init__(self, charset: dict[int, int], base: Optional['SCXCodec'] = None, changed_codes: Iterable[int] = ()) -> None:
+        self._charset = charset
+        self._load = None
+        self._reverse = None
+        self._tables = None
+        self._base = base
+        self._changed_codes = tuple(changed_codes)
+        self._overlay = None
+        self._prepared = base is None
+        self._prepare_lock = threading.Lock()
+
+    @classmethod
+    def deferred(cls, load: Callable[[], dict[int, int]]):
+        codec = cls(None)
+        codec._load = load
+        return codec
+
+    @property
+    def charset(self) -> dict[int, int]:
+        # 多个线程同时第一次使用时可能各自调用load，结果相同
+        if self._charset is None: self._charset = self._load()
+        return self._charset
 
-    def __init__(self, charset: dict[int, int]) -> None:
-        self.charset = charset
-        self._revmap = {v: k for k, v in charset.items()}
+    @property
+    def _revmap(self) -> dict[int, int]:
+        if self._reverse is None: self._reverse = {v: k for k, v in self.charset.items()}
+        return self._reverse
 
     @classmethod
     def from_string(cls, charset: str, omit_char: str = '\0'):
@@ -15,17 +63,129 @@ class SCXCodec:
     @classmethod
     def base_on(cls, base: 'SCXCodec', replaces: Iterable[tuple[str, str]]):
         new_charset = base.charset.copy()
+        changed = list[int]()
         for orig, new in replaces:
-            new_charset[base._revmap[ord(orig)]] = ord(new)
-        return cls(new_charset)
+            code = base._revmap[ord(orig)]
+            new_charset[code] = ord(new)
+            changed.append(code)
+        return cls(new_charset, base, changed)
+
+    def build_tables(self):
+        decode_table = [None] * 0x10000
+        for code, char in self.charset.items(): decode_table[code] = char
+        encode_table = [None] * 0x10000
+        text_table = [None] * 0x10000
+        for char, code in self._revmap.items():
+            if char < 0x10000:
+                encode_table[char] = code
+                text_table[char] = code | (TEXT_BIT << 8)
+        return decode_table, encode_table, text_table
+
+    def make_overlay(self, base: 'SCXCodec'):
+        # 无法用基础codec的表加替换得到同样结果时返回None
+        counts = Counter(base.charset.values())
+        encode_before = dict[int, int | None]()
+        decode_after = dict[int, int]()
+        chars = set[int]()
+        for code in self._changed_codes:
+            old, new = base.charset[code], self.charset[code]
+            if counts[old] != 1: return None # 其他码位也解码为旧字符，解码后无法区分
+            if old != new: decode_after[old] = new
+            chars.add(old); chars.add(new)
+        for char in chars:
+            if char >= 0x10000: continue # 与完整的表相同，超出范围的字符保持原样
+            if (code := self._revmap.get(char)) is None:
+                encode_before[char] = None
+                continue
+            target = base.charset.get(code)
+            if target is None or target >= 0x10000 or base._revmap.get(target) != code: return None
+            if target != char: encode_before[char] = target
+        return encode_before, decode_after
+
+    def _prepare(self):
+        # 第一次编解码时才决定沿用基础codec的表还是生成完整的表
+        # 可能有多个线程同时第一次使用，在锁内计算，最后才设置_prepared，其他线程看到它时_overlay与_base已经就绪
+        with self._prepare_lock:
+            if self._prepared: return
+            overlay = self.make_overlay(self._base)
+            if overlay is None: self._base = None
+            self._overlay = overlay
+            self._prepared = True
+
+    def tables(self):
+        if self._tables is None: self._tables = self.build_tables()
+        return self._tables
+
+    def _translate_decode(self, text: str) -> str:
+        if not self._prepared: self._prepare()
+        if self._overlay is None: return text.translate(self._decode_table)
+        return self._base._translate_decode(text).translate(self._overlay[1])
+
+    def _translate_encode(self, text: str, text_bit: bool) -> str:
+        if not self._prepared: self._prepare()
+        if self._overlay is None: return text.translate(self._text_table if text_bit else self._encode_table)
+        return self._base._translate_encode(text.translate(self._overlay[0]), text_bit)
+
+    @property
+    def _decode_table(self): return self.tables()[0]
+
+    @property
+    def _encode_table(self): return self.tables()[1]
+
+    @property
+    def _text_table(self): return self.tables()[2] # 字符码已带TextBit，按大端序UTF-16编码即为SCX中的字节
 
     def decode(self, data: Iterable[int]):
-        return ''.join(chr(self.charset[c]) for c in data)
+        if not (isinstance(data, array) and data.typecode == 'H'): data = array('H', data)
+        result = self._translate_decode(data.tobytes().decode(NATIVE_UTF16, 'surrogatepass'))
+        if len(result) != len(data):
+            raise UnmappedCharacterError([(i, c) for i, c in enumerate(data) if c not in self.charset])
+        return result
 
     def encode(self, data: str):
-        for c in data: yield self._revmap[ord(c)]
+        translated = self._translate_encode(data, False)
+        result = array('H', translated.encode(NATIVE_UTF16, 'surrogatepass'))
+        if len(translated) != len(data) or len(result) != len(data):
+            raise UnmappedCharacterError([(i, ord(c)) for i, c in enumerate(data) if ord(c) not in self._revmap])
+        return result
 
-DEFAULT_CODEC = SCXCodec.from_string(
+    def encode_text(self, data: str) -> bytes:
+        # 直接得到写入SCX的字节
+        translated = self._translate_encode(data, True)
+        result = translated.encode('utf-16-be', 'surrogatepass')
+        if len(translated) != len(data) or len(result) != 2 * len(data):
+            raise UnmappedCharacterError([(i, ord(c)) for i, c in enumerate(data) if ord(c) not in self._revmap])
+        return result
+
+    def decode_many(self, data: Sequence[Iterable[int]]) -> list[str]:
+        # 拼接后整体查表，再按长度切分
+        units = [d if isinstance(d, array) and d.typecode == 'H' else array('H', d) for d in data]
+        joined = array('H')
+        for d in units: joined.extend(d)
+        try: text = self.decode(joined)
+        except UnmappedCharacterError:
+            for item, d in enumerate(units):
+                try: self.decode(d)
+                except UnmappedCharacterError as e: raise UnmappedCharacterError(e.unmapped, item) from None
+            raise
+        result = list[str](); pos = 0
+        for d in units:
+            result.append(text[pos:pos + len(d)]); pos += len(d)
+        return result
+
+    def encode_many(self, data: Sequence[str]) -> list['array[int]']:
+        try: joined = self.encode(''.join(data))
+        except UnmappedCharacterError:
+            for item, d in enumerate(data):
+                try: self.encode(d)
+                except UnmappedCharacterError as e: raise UnmappedCharacterError(e.unmapped, item) from None
+            raise
+        result = list['array[int]'](); pos = 0
+        for d in data:
+            result.append(joined[pos:pos + len(d)]); pos += len(d)
+        return result
+
+DEFAULT_CHARSET = (
     ' 0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz\u3000' \
     "/:-;!?'.@#%~*&`()°^>+<ﾉ･=″$′,[\\]_{|}\ue000\ue001\ue002\ue003\ue004\ue005\ue006\ue007\ue008\ue009\ue00a\ue00b\ue00c\ue00d\ue00e\ue00f\ue010\ue011\ue012\ue013\ue014\ue015\ue016\ue017\ue018\ue019\ue01a…" \
     '０１２３４５６７８９ＡＢＣＤＥＦＧＨＩＪＫＬＭＮＯＰＱＲＳＴＵＶＷＸＹＺａｂｃｄｅｆｇｈｉｊｋｌｍｎｏｐｑｒｓｔｕｖｗｘｙｚ、。' \
@@ -38,3 +198,11 @@ DEFAULT_CODEC = SCXCodec.from_string(
     'ダチヂツヅテデトドナニヌネノハバパヒビピフブプヘベペホボポマミムメモヤユヨラリルレロヮワヰヱヲンヴΑΒΓΔΕΖΗΘΙΚΛΜΝΞΟ' \
     'ΠΡΣΤΥΦΧΨΩⅠⅡⅢⅣⅤⅥⅦⅧⅨⅩ∮∑∟⊿Я'
 )
+
+def __getattr__(name: str):
+    # DEFAULT_CODEC由字符集登记处中的default构造，字符集在第一次编解码时才取得，可使用跨进程的缓存
+    if name == 'DEFAULT_CODEC':
+        from .charsets import charsets # 在此导入以免循环导入
+        codec = globals()['DEFAULT_CODEC'] = charsets.get('default')
+        return codec
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
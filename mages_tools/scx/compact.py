@@ -0,0 +1,69 @@
+from array import array
+from typing import ByteString, Iterable, Iterator, Callable
+from mages_tools.io import *
+from .codec import DEFAULT_CODEC
+from .tokenizer import TokenType, SCXToken, registry, tokenize_from_buffer, untokenize_to_buffer
+
+class TokenStream:
+    # 以数组保存多条字符串的词法单元，不为每个单元创建对象
+    # codes: 每个单元的类型，文本为TextBit
+    # starts: 每个单元在pool中的起始位置，多一项作为结尾
+    # pool: 文本原样保存；控制符保存其dump结果去掉类型字节后的部分，按latin-1逐字节存为字符
+    # string_starts: 每条字符串的第一个单元序号，多一项作为结尾
+    __slots__ = ('codes', 'starts', 'pool', 'string_starts')
+    codes: 'array[int]'
+    starts: 'array[int]'
+    pool: str
+    string_starts: 'array[int]'
+
+    def __init__(self, codes: 'array[int]', starts: 'array[int]', pool: str, string_starts: 'array[int]'):
+        self.codes = codes
+        self.starts = starts
+        self.pool = pool
+        self.string_starts = string_starts
+
+    @classmethod
+    def from_token_lists(cls, token_lists: Iterable[Iterable[str | SCXToken]]):
+        codes = array('B'); starts = array('I', [0]); string_starts = array('I', [0])
+        pieces = list[str](); pos = 0
+        for tokens in token_lists:
+            for token in tokens:
+                if isinstance(token, str):
+                    codes.append(TokenType.TextBit)
+                    piece = token
+                elif isinstance(token, SCXToken):
+                    buf = untokenize_to_buffer([token])
+                    codes.append(buf[0])
+                    piece = buf[1:].decode('latin-1')
+                else:
+                    raise ValueError('invalid token')
+                pieces.append(piece)
+                pos += len(piece)
+                starts.append(pos)
+            string_starts.append(len(codes))
+        return cls(codes, starts, ''.join(pieces), string_starts)
+
+    @classmethod
+    def from_strings(cls, strings: Iterable[ByteString], decoder: Callable[['array[int]'], str] = DEFAULT_CODEC.decode):
+        return cls.from_token_lists(tokenize_from_buffer(strn, decoder) for strn in strings)
+
+    def token(self, idx: int) -> str | SCXToken:
+        piece = self.pool[self.starts[idx]:self.starts[idx + 1]]
+        code = self.codes[idx]
+        if code == TokenType.TextBit: return piece
+        typ = TokenType(code)
+        return registry[typ].load(typ, ROBuffer(piece.encode('latin-1')))
+
+    def tokens(self, stridx: int) -> list[str | SCXToken]:
+        if stridx < 0: stridx += len(self)
+        if not 0 <= stridx < len(self): raise IndexError('string index out of range')
+        return [self.token(idx) for idx in range(self.string_starts[stridx], self.string_starts[stridx + 1])]
+
+    def __len__(self): return len(self.string_starts) - 1
+
+    def __getitem__(self, stridx: int): return self.tokens(stridx)
+
+    def __iter__(self) -> Iterator[list[str | SCXToken]]:
+        for stridx in range(len(self)): yield self.tokens(stridx)
+
+    def to_token_lists(self): return list(self)
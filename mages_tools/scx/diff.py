@@ -0,0 +1,27 @@
+from typing import ByteString
+from pathlib import Path
+from dataclasses import dataclass, field
+from .lazy import LazySCXLayout
+
+@dataclass(slots=True)
+class StringDiff:
+    # 均为字符串序号
+    added: list[int] = field(default_factory=list)
+    removed: list[int] = field(default_factory=list)
+    modified: list[int] = field(default_factory=list)
+
+def compare(old: LazySCXLayout, new: LazySCXLayout):
+    result = StringDiff()
+    common = min(len(old), len(new))
+    result.modified = [stridx for stridx in range(common) if old.raw(stridx) != new.raw(stridx)]
+    result.removed = list(range(common, len(old)))
+    result.added = list(range(common, len(new)))
+    return result
+
+def diff_strings(old: ByteString, new: ByteString):
+    with LazySCXLayout(old) as old_scx, LazySCXLayout(new) as new_scx:
+        return compare(old_scx, new_scx)
+
+def diff_files(old_path: Path, new_path: Path):
+    with LazySCXLayout.open(old_path) as old_scx, LazySCXLayout.open(new_path) as new_scx:
+        return compare(old_scx, new_scx)
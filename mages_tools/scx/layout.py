@@ -1,9 +1,34 @@
-from typing import Optional, Iterable
+from typing import Optional, Iterable, Sequence, Mapping
 from pathlib import Path
 from array import array
+from itertools import accumulate
 from dataclasses import dataclass
 from mages_tools.errors import *
 from mages_tools.io import *
+from mages_tools import stats
+from .codec import SCXCodec, DEFAULT_CODEC
+from .tokenizer import TokenType, SCXToken, untokenize_many
+
+def string_addresses(start: int, sizes: Sequence[int], order: Sequence[int]) -> 'array[int]':
+    # 按order排列后求前缀和得到各字符串的位置，结果按字符串序号排列
+    if isinstance(order, range) and order == range(len(sizes)):
+        return array('I', accumulate(sizes[:-1], initial=start)) if sizes else array('I')
+    result = array('I', bytes(4 * len(sizes)))
+    for stridx, addr in zip(order, accumulate([sizes[stridx] for stridx in order], initial=start)):
+        result[stridx] = addr
+    return result
+
+def encode_replacements(replaces: Mapping[int, str | Iterable[str | SCXToken]], count: int, codec: SCXCodec = DEFAULT_CODEC, cache=None) -> list[tuple[int, bytes]]:
+    # 批量编码替换的字符串，值为纯文本或token列表；所有文本一次编码，结果含结尾的Termination，按序号排列
+    # cache为TokenCache时重复的字符串只编码一次
+    indices = sorted(replaces)
+    for stridx in indices:
+        if not 0 <= stridx < count: raise IndexError(stridx)
+    token_lists = [[tokens] if isinstance(tokens, str) else tokens for tokens in map(replaces.__getitem__, indices)]
+    with stats.stage('scx.rewrite'):
+        if cache is None: encoded = untokenize_many(token_lists, codec)
+        else: encoded = cache.untokenize_many(token_lists, codec)
+        return [(stridx, strn + bytes([TokenType.Termination])) for stridx, strn in zip(indices, encoded)]
 
 @dataclass(slots=True)
 class SCXLayout:
@@ -23,35 +48,38 @@ class SCXLayout:
 
     @classmethod
     def load(cls, data: Readable):
-        # 检查文件头
-        if data.read(len(cls.HEADER)) != cls.HEADER:
-            raise InvalidDataError("SCX header mismatch")
-        # 读取表位置
-        string_table_addr = data.read_u32()
-        return_addr_table_addr = data.read_u32()
-        # 读取标签表
-        entry_label = data.read_u32()
-        labels = array('L', [entry_label])
-        labels.frombytes(data.read_until(entry_label))
-        # 读取代码区
-        code_data = data.read_until(string_table_addr)
-        # 读取字符串表
-        string_addrs = array('L', data.read_until(return_addr_table_addr))
-        string_order = sorted(range(len(string_addrs)), key=lambda i: string_addrs[i])
-        # 注：字符串表可能为空
-        if string_addrs:
-            # 读取返回地址表
-            return_addrs = array('L', data.read_until(string_addrs[string_order[0]]))
-            # 读取字符串数据
-            string_data = [b''] * len(string_addrs)
-            for cur, nxt in zip(string_order[:-1], string_order[1:]):
-                string_data[cur] = data.read_until(string_addrs[nxt])
-            string_data[string_order[-1]] = data.read_until(data.size())
-        else:
-            # 读取返回地址表
-            return_addrs = array('L', data.read_until(data.size()))
-            # 无字符串数据
-            string_data = list[bytes]()
+        with stats.stage('scx.load'):
+            # 检查文件头
+            if data.read(len(cls.HEADER)) != cls.HEADER:
+                raise InvalidDataError("SCX header mismatch")
+            # 读取表位置
+            string_table_addr = data.read_u32()
+            return_addr_table_addr = data.read_u32()
+            # 读取标签表（data可能返回memoryview，因此用frombytes构造数组、用bytes保存数据）
+            entry_label = data.read_u32()
+            labels = array('I', [entry_label])
+            labels.frombytes(data.read_until(entry_label))
+            # 读取代码区
+            code_data = bytes(data.read_until(string_table_addr))
+            # 读取字符串表
+            string_addrs = array('I')
+            string_addrs.frombytes(data.read_until(return_addr_table_addr))
+            string_order = sorted(range(len(string_addrs)), key=lambda i: string_addrs[i])
+            # 注：字符串表可能为空
+            return_addrs = array('I')
+            if string_addrs:
+                # 读取返回地址表
+                return_addrs.frombytes(data.read_until(string_addrs[string_order[0]]))
+                # 读取字符串数据
+                string_data = [b''] * len(string_addrs)
+                for cur, nxt in zip(string_order[:-1], string_order[1:]):
+                    string_data[cur] = bytes(data.read_until(string_addrs[nxt]))
+                string_data[string_order[-1]] = bytes(data.read_until(data.size()))
+            else:
+                # 读取返回地址表
+                return_addrs.frombytes(data.read_until(data.size()))
+                # 无字符串数据
+                string_data = list[bytes]()
         # 返回结果
         return cls(
             entry_label=entry_label,
@@ -63,36 +91,38 @@ class SCXLayout:
         )
 
     def dump(self, data: Writable, follow_given_order: bool = False):
-        # 写入文件头
-        data.write(self.HEADER)
-        # 写入表位置
-        string_table_addr = len(self.HEADER) + 4 * 2 + 4 * len(self.labels) + len(self.codes_raw)
-        data.write_u32(string_table_addr)
-        return_addr_table_addr = string_table_addr + 4 * len(self.strings_raw)
-        data.write_u32(return_addr_table_addr)
-        # 写入标签表
-        data.write(self.labels.tobytes())
-        # 写入代码区
-        data.write(self.codes_raw)
-        # 写入字符串表
-        string_data_addr = return_addr_table_addr + 4 * len(self.return_addrs)
-        string_addrs = array('L', [string_data_addr] * len(self.strings_raw))
-        stroff = 0
-        for stridx in self.string_dump_order(follow_given_order):
-            string_addrs[stridx] += stroff
-            stroff += len(self.strings_raw[stridx])
-        data.write(string_addrs.tobytes())
-        # 写入返回地址表
-        data.write(self.return_addrs.tobytes())
-        # 写入字符串数据
-        for stridx in self.string_dump_order(follow_given_order):
-            data.write(self.strings_raw[stridx])
+        with stats.stage('scx.dump'):
+            # 写入文件头
+            data.write(self.HEADER)
+            # 写入表位置
+            string_table_addr = len(self.HEADER) + 4 * 2 + 4 * len(self.labels) + len(self.codes_raw)
+            data.write_u32(string_table_addr)
+            return_addr_table_addr = string_table_addr + 4 * len(self.strings_raw)
+            data.write_u32(return_addr_table_addr)
+            # 写入标签表
+            data.write(self.labels.tobytes())
+            # 写入代码区
+            data.write(self.codes_raw)
+            # 写入字符串表
+            string_data_addr = return_addr_table_addr + 4 * len(self.return_addrs)
+            dump_order = self.string_dump_order(follow_given_order)
+            string_addrs = string_addresses(string_data_addr, list(map(len, self.strings_raw)), dump_order)
+            data.write(string_addrs.tobytes())
+            # 写入返回地址表
+            data.write(self.return_addrs.tobytes())
+            # 写入字符串数据
+            data.writev([self.strings_raw[stridx] for stridx in dump_order])
+
+    def rewrite(self, replaces: Mapping[int, str | Iterable[str | SCXToken]], codec: SCXCodec = DEFAULT_CODEC, cache=None):
+        # 批量替换字符串，string_order不变；以follow_given_order写出时字符串数据保持原有的排列顺序
+        for stridx, strn in encode_replacements(replaces, len(self.strings_raw), codec, cache):
+            self.strings_raw[stridx] = strn
 
     @classmethod
     def read(cls, path: str | Path):
-        with open(path, 'rb') as fp:
-            return cls.load(FileWrapper(fp))
+        with MMapReader.open(path) as data:
+            return cls.load(data)
 
-    def write(self, path: str | Path):
-        with open(path, 'wb') as fp:
-            self.dump(FileWrapper(fp))
+    def write(self, path: str | Path, follow_given_order: bool = False):
+        with open(path, 'wb') as fp, BufferedWriter(fp) as data:
+            self.dump(data, follow_given_order)
@@ -0,0 +1,166 @@
+from typing import ByteString, Optional, Iterable, Callable, Mapping
+from pathlib import Path
+from array import array
+import os
+from mages_tools.errors import *
+from mages_tools.io import *
+from mages_tools import stats
+from .layout import SCXLayout, string_addresses, encode_replacements
+from .codec import SCXCodec, DEFAULT_CODEC
+from .tokenizer import TokenType, SCXToken, tokenize_from_buffer, untokenize_to_buffer
+
+# 只解析表位置与字符串表，代码区与字符串数据以memoryview切片的形式保留
+# 修改记录在overlays中，写出时未修改的相邻字符串整段复制
+class LazySCXLayout:
+    entry_label: int
+    labels: memoryview
+    codes_raw: memoryview
+    return_addrs: memoryview
+    string_addrs: 'array[int]'
+    string_order: list[int] # 字符串数据的排列顺序（按位置）
+    string_ends: 'array[int]'
+    overlays: dict[int, bytes]
+    _view: memoryview
+    _reader: Optional[MMapReader]
+
+    def __init__(self, buf: ByteString, reader: Optional[MMapReader] = None):
+        view = memoryview(buf).cast('B')
+        try:
+            with stats.stage('scx.lazy.load'):
+                self._parse(view)
+        except BaseException:
+            view.release(); raise
+        self.overlays = dict[int, bytes]()
+        self._view = view
+        self._reader = reader
+
+    def _parse(self, view: memoryview):
+        data = ROBuffer(view)
+        # 检查文件头
+        if data.read(len(SCXLayout.HEADER)) != SCXLayout.HEADER:
+            raise InvalidDataError("SCX header mismatch")
+        # 读取表位置
+        string_table_addr = data.read_u32()
+        return_addr_table_addr = data.read_u32()
+        self.entry_label = data.read_u32()
+        size = len(view)
+        if not (data.tell() <= self.entry_label <= string_table_addr <= return_addr_table_addr <= size):
+            raise InvalidDataError("SCX table address out of range")
+        if (return_addr_table_addr - string_table_addr) % 4 or (self.entry_label - data.tell() + 4) % 4:
+            raise InvalidDataError("SCX table size not aligned")
+        # 标签表（含第一项）与返回地址表按原样保留
+        self.labels = view[data.tell() - 4:self.entry_label]
+        self.codes_raw = view[self.entry_label:string_table_addr]
+        self.string_addrs = array('I')
+        self.string_addrs.frombytes(view[string_table_addr:return_addr_table_addr])
+        self.string_order = sorted(range(len(self.string_addrs)), key=self.string_addrs.__getitem__)
+        # 每个字符串到下一个字符串（按位置）为止，最后一个到文件末尾
+        string_data_addr = self.string_addrs[self.string_order[0]] if self.string_addrs else size
+        if not (return_addr_table_addr <= string_data_addr and (return_addr_table_addr - string_data_addr) % 4 == 0):
+            raise InvalidDataError("SCX string data address out of range")
+        if self.string_addrs and self.string_addrs[self.string_order[-1]] > size:
+            raise InvalidDataError("SCX string data address out of range")
+        self.return_addrs = view[return_addr_table_addr:string_data_addr]
+        self.string_ends = array('I', bytes(4 * len(self.string_addrs)))
+        for cur, nxt in zip(self.string_order, self.string_order[1:] + [None]):
+            self.string_ends[cur] = size if nxt is None else self.string_addrs[nxt]
+
+    @classmethod
+    def open(cls, path: str | Path):
+        reader = MMapReader.open(path)
+        try: return cls(reader.buf, reader)
+        except BaseException:
+            reader.close(); raise
+
+    def close(self):
+        for view in (self.labels, self.codes_raw, self.return_addrs, self._view): view.release()
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def __enter__(self): return self
+
+    def __exit__(self, *exc): self.close()
+
+    def __len__(self): return len(self.string_addrs)
+
+    def raw(self, stridx: int) -> ByteString:
+        # 含结尾的Termination
+        if (overlay := self.overlays.get(stridx)) is not None: return overlay
+        return self._view[self.string_addrs[stridx]:self.string_ends[stridx]]
+
+    def tokens(self, stridx: int, decoder: Callable[['array[int]'], str] = DEFAULT_CODEC.decode):
+        return list(tokenize_from_buffer(self.raw(stridx), decoder))
+
+    def set_raw(self, stridx: int, strn: ByteString):
+        if not 0 <= stridx < len(self): raise IndexError(stridx)
+        self.overlays[stridx] = bytes(strn)
+
+    def set_tokens(self, stridx: int, tokens: Iterable[str | SCXToken], encoder: Callable[[str], Iterable[int]] = DEFAULT_CODEC.encode):
+        self.set_raw(stridx, untokenize_to_buffer(tokens, encoder) + bytes([TokenType.Termination]))
+
+    def rewrite(self, replaces: Mapping[int, str | Iterable[str | SCXToken]], codec: SCXCodec = DEFAULT_CODEC, cache=None):
+        # 与SCXLayout.rewrite相同，结果记录在overlays中
+        self.overlays.update(encode_replacements(replaces, len(self), codec, cache))
+
+    def revert(self, stridx: int):
+        self.overlays.pop(stridx, None)
+
+    def string_sizes(self):
+        sizes = array('I', (end - start for start, end in zip(self.string_addrs, self.string_ends)))
+        for stridx, overlay in self.overlays.items(): sizes[stridx] = len(overlay)
+        return sizes
+
+    def dump(self, data: Writable):
+        # 按原有位置顺序写出字符串，未修改且原本相邻的字符串合并为一次写入
+        with stats.stage('scx.lazy.dump'):
+            header_size = len(SCXLayout.HEADER) + 4 * 2
+            string_table_addr = header_size + len(self.labels) + len(self.codes_raw)
+            return_addr_table_addr = string_table_addr + 4 * len(self)
+            string_data_addr = return_addr_table_addr + len(self.return_addrs)
+            data.write(SCXLayout.HEADER)
+            data.write_u32(string_table_addr)
+            data.write_u32(return_addr_table_addr)
+            data.write(self.labels)
+            data.write(self.codes_raw)
+            data.write(string_addresses(string_data_addr, self.string_sizes(), self.string_order).tobytes())
+            data.write(self.return_addrs)
+            pieces = list[ByteString]()
+            run_start = run_end = None
+            for stridx in self.string_order:
+                if stridx in self.overlays:
+                    if run_start is not None: pieces.append(self._view[run_start:run_end])
+                    run_start = None
+                    pieces.append(self.overlays[stridx])
+                elif run_start is not None and run_end == self.string_addrs[stridx]:
+                    run_end = self.string_ends[stridx]
+                else:
+                    if run_start is not None: pieces.append(self._view[run_start:run_end])
+                    run_start, run_end = self.string_addrs[stridx], self.string_ends[stridx]
+            if run_start is not None: pieces.append(self._view[run_start:run_end])
+            data.writev(pieces)
+
+    def write(self, path: str | Path):
+        # 目标可能就是映射中的文件，先写到临时文件
+        path = Path(path)
+        tmp_path = path.with_name(path.name + '.tmp')
+        try:
+            with open(tmp_path, 'wb') as fp, BufferedWriter(fp) as data:
+                self.dump(data)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True); raise
+        os.replace(tmp_path, path)
+
+    def to_layout(self):
+        labels = array('I')
+        labels.frombytes(self.labels)
+        return_addrs = array('I')
+        return_addrs.frombytes(self.return_addrs)
+        return SCXLayout(
+            entry_label=self.entry_label,
+            labels=labels,
+            codes_raw=bytes(self.codes_raw),
+            return_addrs=return_addrs,
+            strings_raw=[bytes(self.raw(stridx)) for stridx in range(len(self))],
+            string_order=list(self.string_order),
+        )
@@ -1,11 +1,14 @@
 from abc import ABC, abstractmethod
 from io import BytesIO
+import re
+import sys
 from array import array
 from typing import ByteString, Iterable, Callable
 from enum import IntEnum
-from .codec import DEFAULT_CODEC
+from .codec import SCXCodec, DEFAULT_CODEC
 from mages_tools.errors import *
 from mages_tools.io import *
+from mages_tools import stats
 
 
 class TokenType(IntEnum):
@@ -30,6 +33,7 @@ class TokenType(IntEnum):
     Termination             = 0b11111111
 
 class SCXToken(ABC):
+    __slots__ = ('type',)
     type: TokenType
 
     def __init__(self, typ: TokenType):
@@ -64,6 +68,18 @@ def register_for(code: TokenType):
 @register_for(TokenType.ChaosCommand2)
 @register_for(TokenType.SetAlignmentCenter)
 class BareToken(SCXToken):
+    # 无参数，每种类型只保留一个共享实例
+    __slots__ = ()
+    _instances: dict[TokenType, 'BareToken'] = {}
+
+    def __new__(cls, typ: TokenType):
+        if (inst := cls._instances.get(typ)) is None:
+            inst = cls._instances[typ] = super().__new__(cls)
+        return inst
+
+    def __reduce__(self):
+        return (type(self), (self.type,))
+
     @classmethod
     def load(cls, typ: TokenType, data: Readable):
         return cls(typ)
@@ -71,6 +87,12 @@ class BareToken(SCXToken):
     def dump(self, data: Writable):
         data.write_u8(self.type.value)
 
+    def __eq__(self, other):
+        return type(other) is type(self) and other.type == self.type
+
+    def __hash__(self):
+        return hash((type(self), self.type))
+
     def __repr__(self):
         return f'<{self.type.name}()>'
 
@@ -79,6 +101,7 @@ class BareToken(SCXToken):
 @register_for(TokenType.SetLeftMargin)
 @register_for(TokenType.ChaosCommand3)
 class UnaryToken(SCXToken):
+    __slots__ = ('arg',)
     arg: int
 
     def __init__(self, typ: TokenType, arg: int):
@@ -93,12 +116,19 @@ class UnaryToken(SCXToken):
         data.write_u8(self.type.value)
         data.write_i16(self.arg)
 
+    def __eq__(self, other):
+        return type(other) is type(self) and (other.type, other.arg) == (self.type, self.arg)
+
+    def __hash__(self):
+        return hash((type(self), self.type, self.arg))
+
     def __repr__(self):
         return f'<{self.type.name}({self.arg})>'
 
 @register_for(TokenType.SetColor)
 @register_for(TokenType.EvaluateExpression)
 class ExpressionToken(SCXToken):
+    __slots__ = ('args',)
     args: list[tuple[int, bytes]]
 
     def __init__(self, typ: TokenType, args: list[tuple[int, bytes]]):
@@ -120,6 +150,15 @@ class ExpressionToken(SCXToken):
             data.write(expr)
         data.write_u8(0)
 
+    def _key(self):
+        return (self.type, tuple((ctrl, bytes(expr)) for ctrl, expr in self.args))
+
+    def __eq__(self, other):
+        return type(other) is type(self) and other._key() == self._key()
+
+    def __hash__(self):
+        return hash((type(self), self._key()))
+
     def __repr__(self):
         return f'<{self.type.name}({self.args})>'
 
@@ -142,23 +181,113 @@ def tokenize(data: Readable, decoder: Callable[['array[int]'], str] = DEFAULT_CO
     if text_buf:
         yield decoder(text_buf)
 
+# 连续的文本字符（高字节带TextBit，且不是Termination）
+TEXT_RUN = re.compile(rb'(?:[\x80-\xfe][\x00-\xff])+')
+# 清除/设置TextBit的字节转换表
+CLEAR_TEXT_BIT = bytes(range(0x80)) * 2
+SET_TEXT_BIT = bytes(range(0x80, 0x100)) * 2
+
+def text_run_units(run: ByteString):
+    units = bytearray(run)
+    units[0::2] = units[0::2].translate(CLEAR_TEXT_BIT)
+    result = array('H', units)
+    if sys.byteorder == 'little': result.byteswap() # 文本字符为大端序
+    return result
+
+def text_run_bytes(units: Iterable[int]):
+    # text_run_units的逆操作
+    units = array('H', units) # 复制后再转换字节序
+    if sys.byteorder == 'little': units.byteswap()
+    result = bytearray(units.tobytes())
+    result[0::2] = result[0::2].translate(SET_TEXT_BIT)
+    return bytes(result)
+
 def tokenize_from_buffer(strn: ByteString, decoder: Callable[['array[int]'], str] = DEFAULT_CODEC.decode):
-    yield from tokenize(ROBuffer(strn), decoder)
+    # 与tokenize结果相同，但整段匹配文本，只有控制符才逐个交给registry解析
+    data = ROBuffer(strn)
+    size = len(strn)
+    if stats.active is not None:
+        stats.active.add('scx.tokenize.strings', 1)
+        stats.active.add('scx.tokenize.bytes', size)
+    pos = 0
+    while pos < size:
+        if (run := TEXT_RUN.match(strn, pos)) is not None:
+            yield decoder(text_run_units(run.group()))
+            pos = run.end()
+            continue
+        code = strn[pos]
+        if code == TokenType.Termination: return
+        if code & TokenType.TextBit: raise InvalidDataError('truncated text character')
+        try: typ = TokenType(code)
+        except ValueError: raise ValueError(f'unknown token type {bin(code)}')
+        data.seek(pos + 1)
+        yield registry[typ].load(typ, data)
+        pos = data.tell()
 
 def untokenize(tokens: Iterable[str | SCXToken], data: Writable, encoder: Callable[[str], Iterable[int]] = DEFAULT_CODEC.encode):
     for token in tokens:
         if isinstance(token, SCXToken):
             token.dump(data)
         elif isinstance(token, str):
-            for u16ord in encoder(token):
-                hi = u16ord >> 8
-                lo = u16ord & 0xFF
-                data.write_u8(hi | TokenType.TextBit)
-                data.write_u8(lo)
+            data.write(text_run_bytes(encoder(token)))
         else:
             raise ValueError('invalid token')
 
 def untokenize_to_buffer(tokens: Iterable[str | SCXToken], encoder: Callable[[str], Iterable[int]] = DEFAULT_CODEC.encode):
     buf = BytesIO()
     untokenize(tokens, FileWrapper(buf), encoder)
+    if stats.active is not None:
+        stats.active.add('scx.untokenize.strings', 1)
+        stats.active.add('scx.untokenize.bytes', buf.tell())
     return buf.getvalue()
+
+def tokenize_many(strings: Iterable[ByteString], codec: SCXCodec = DEFAULT_CODEC):
+    # 先收集所有字符串中的文本，一次性解码后再放回原位
+    results = list[list[str | SCXToken]]()
+    texts = list['array[int]']()
+    places = list[tuple[int, int]]()
+    for stridx, strn in enumerate(strings):
+        tokens = list[str | SCXToken]()
+        for token in tokenize_from_buffer(strn, lambda units: units):
+            if isinstance(token, array):
+                places.append((stridx, len(tokens)))
+                texts.append(token)
+            tokens.append(token)
+        results.append(tokens)
+    try: decoded = codec.decode_many(texts)
+    except UnmappedCharacterError as e:
+        raise UnmappedCharacterError(e.unmapped, places[e.item][0]) from None
+    for (stridx, tokidx), text in zip(places, decoded):
+        results[stridx][tokidx] = text
+    return results
+
+def untokenize_many(token_lists: Iterable[Iterable[str | SCXToken]], codec: SCXCodec = DEFAULT_CODEC):
+    # 先一次性把所有文本编码成SCX字节，再与控制符依次写入同一个缓冲区
+    token_lists = [list(tokens) for tokens in token_lists]
+    texts = [token for tokens in token_lists for token in tokens if isinstance(token, str)]
+    try: encoded = codec.encode_text(''.join(texts))
+    except UnmappedCharacterError:
+        owners = [stridx for stridx, tokens in enumerate(token_lists) for token in tokens if isinstance(token, str)]
+        for item, text in enumerate(texts):
+            try: codec.encode_text(text)
+            except UnmappedCharacterError as e: raise UnmappedCharacterError(e.unmapped, owners[item]) from None
+        raise
+    buf = BytesIO()
+    data = FileWrapper(buf)
+    ends = list[int]()
+    pos = 0
+    for tokens in token_lists:
+        for token in tokens:
+            if isinstance(token, SCXToken):
+                token.dump(data)
+            elif isinstance(token, str):
+                data.write(encoded[pos:pos + 2 * len(token)])
+                pos += 2 * len(token)
+            else:
+                raise ValueError('invalid token')
+        ends.append(buf.tell())
+    stats.count('scx.untokenize.strings', len(token_lists))
+    stats.count('scx.untokenize.bytes', buf.tell())
+    view = buf.getbuffer()
+    try: return [bytes(view[start:end]) for start, end in zip([0] + ends, ends)]
+    finally: view.release()
@@ -0,0 +1,187 @@
+from abc import ABC, abstractmethod
+from typing import ByteString, Iterable, Optional
+from pathlib import Path
+from array import array
+from itertools import accumulate
+from dataclasses import dataclass, field
+from bisect import bisect_right
+import re
+import struct
+from mages_tools.errors import *
+from mages_tools.io import *
+from mages_tools import stats
+from .layout import SCXLayout
+from .lazy import LazySCXLayout
+
+# 代码区中字符串引用的交叉索引
+# 代码区的指令格式因游戏而异，具体如何找出字符串引用由XrefScanner决定
+
+class XrefScanner(ABC):
+    # key用于判断磁盘上缓存的索引是否由同样的扫描方式生成
+    @property
+    @abstractmethod
+    def key(self) -> str: pass
+
+    @abstractmethod
+    def scan(self, code: ByteString, base: int) -> Iterable[tuple[int, int]]:
+        # 返回(引用处的地址, 字符串序号)，地址为文件中的绝对位置，base为代码区的起始地址
+        pass
+
+@dataclass(slots=True, frozen=True)
+class PatternScanner(XrefScanner):
+    # 在固定的操作码之后（跳过skip字节）读取字符串序号
+    opcode: bytes
+    index_format: str = '<H'
+    skip: int = 0
+
+    @property
+    def key(self):
+        return f'pattern:{self.opcode.hex()}:{self.index_format}:{self.skip}'
+
+    def scan(self, code: ByteString, base: int):
+        index_struct = struct.Struct(self.index_format)
+        for match in re.finditer(re.escape(self.opcode), code):
+            pos = match.end() + self.skip
+            if pos + index_struct.size > len(code): break
+            yield base + match.start(), index_struct.unpack_from(code, pos)[0]
+
+def csr(keys: 'array[int]', count: int) -> 'array[int]':
+    # 按键排好序的数组中各键的起始位置，长度为count+1
+    counts = array('I', bytes(4 * count))
+    for key in keys: counts[key] += 1
+    return array('I', accumulate(counts, initial=0))
+
+XREF_MAGIC = b'SCXR'
+XREF_VERSION = 1
+XREF_HEADER = struct.Struct('<4sIQQIIII') # magic, version, SCX大小, SCX修改时间, key长度, 字符串数, 标签数, 引用数
+
+@dataclass(slots=True)
+class SCXXref:
+    string_count: int
+    label_addrs: 'array[int]' # 按标签序号排列的标签地址
+    label_order: 'array[int]' # 按地址排序后的标签序号
+    # 按字符串序号分组的引用，组内按地址排列
+    string_ref_starts: 'array[int]'
+    string_ref_addrs: 'array[int]'
+    string_ref_labels: 'array[int]'
+    # 按标签序号分组的引用，组内按地址排列
+    label_ref_starts: 'array[int]'
+    label_ref_strings: 'array[int]'
+    label_ref_addrs: 'array[int]'
+    sorted_label_addrs: 'array[int]' = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.sorted_label_addrs = array('I', (self.label_addrs[idx] for idx in self.label_order))
+
+    @classmethod
+    def build(cls, labels: 'array[int]', codes_raw: ByteString, code_addr: int, string_count: int, scanner: XrefScanner):
+        with stats.stage('scx.xref.build'):
+            label_order = array('I', sorted(range(len(labels)), key=labels.__getitem__))
+            sorted_addrs = [labels[idx] for idx in label_order]
+            # 超出范围（含有符号格式读出的负数）的序号视为误判
+            refs = [(addr, stridx) for addr, stridx in scanner.scan(codes_raw, code_addr) if 0 <= stridx < string_count]
+            stats.count('scx.xref.refs', len(refs))
+            ref_labels = list[int]()
+            for addr, _ in refs:
+                pos = bisect_right(sorted_addrs, addr) - 1
+                ref_labels.append(label_order[pos] if pos >= 0 else len(labels)) # 在所有标签之前时记为标签数
+            by_string = sorted(range(len(refs)), key=lambda i: (refs[i][1], refs[i][0]))
+            by_label = sorted(range(len(refs)), key=lambda i: (ref_labels[i], refs[i][0]))
+            string_keys = array('I', (refs[i][1] for i in by_string))
+            label_keys = array('I', (ref_labels[i] for i in by_label))
+            return cls(
+                string_count=string_count,
+                label_addrs=array('I', labels),
+                label_order=label_order,
+                string_ref_starts=csr(string_keys, string_count),
+                string_ref_addrs=array('I', (refs[i][0] for i in by_string)),
+                string_ref_labels=array('I', (ref_labels[i] for i in by_string)),
+                label_ref_starts=csr(label_keys, len(labels) + 1),
+                label_ref_strings=array('I', (refs[i][1] for i in by_label)),
+                label_ref_addrs=array('I', (refs[i][0] for i in by_label)),
+            )
+
+    @classmethod
+    def from_layout(cls, layout: SCXLayout | LazySCXLayout, scanner: XrefScanner):
+        if isinstance(layout, SCXLayout):
+            labels = layout.labels
+            string_count = len(layout.strings_raw)
+        else:
+            labels = array('I')
+            labels.frombytes(layout.labels)
+            string_count = len(layout)
+        return cls.build(labels, layout.codes_raw, layout.entry_label, string_count, scanner)
+
+    def refs_of_string(self, stridx: int) -> list[tuple[int, int]]:
+        # (引用处的地址, 所在的标签序号)
+        start, end = self.string_ref_starts[stridx], self.string_ref_starts[stridx + 1]
+        return list(zip(self.string_ref_addrs[start:end], self.string_ref_labels[start:end]))
+
+    def labels_of_string(self, stridx: int) -> list[int]:
+        start, end = self.string_ref_starts[stridx], self.string_ref_starts[stridx + 1]
+        return sorted(set(self.string_ref_labels[start:end]))
+
+    def strings_of_label(self, label: int) -> 'array[int]':
+        # 按出现的地址顺序
+        return self.label_ref_strings[self.label_ref_starts[label]:self.label_ref_starts[label + 1]]
+
+    def string_range_of_label(self, label: int) -> Optional[range]:
+        strings = self.strings_of_label(label)
+        return range(min(strings), max(strings) + 1) if strings else None
+
+    def label_at(self, addr: int) -> Optional[int]:
+        pos = bisect_right(self.sorted_label_addrs, addr) - 1
+        return self.label_order[pos] if pos >= 0 else None
+
+    @staticmethod
+    def path_for(scx_path: Path):
+        return scx_path.with_name(scx_path.name + '.xref')
+
+    def arrays(self):
+        return (
+            self.label_addrs, self.label_order,
+            self.string_ref_starts, self.string_ref_addrs, self.string_ref_labels,
+            self.label_ref_starts, self.label_ref_strings, self.label_ref_addrs,
+        )
+
+    def write(self, path: Path, scx_size: int, scx_mtime_ns: int, key: str):
+        key_raw = key.encode()
+        with open(path, 'wb') as fp, BufferedWriter(fp) as data:
+            data.write(XREF_HEADER.pack(
+                XREF_MAGIC, XREF_VERSION, scx_size, scx_mtime_ns, len(key_raw),
+                self.string_count, len(self.label_addrs), len(self.string_ref_addrs),
+            ))
+            data.write(key_raw)
+            for arr in self.arrays(): data.write(arr.tobytes())
+
+    @classmethod
+    def read(cls, path: Path, scx_size: int, scx_mtime_ns: int, key: str) -> Optional['SCXXref']:
+        # 与SCX或扫描方式不符、或文件不完整时返回None
+        try: raw = path.read_bytes()
+        except FileNotFoundError: return None
+        if len(raw) < XREF_HEADER.size: return None
+        magic, version, size, mtime_ns, key_size, string_count, label_count, ref_count = XREF_HEADER.unpack_from(raw)
+        if (magic, version, size, mtime_ns) != (XREF_MAGIC, XREF_VERSION, scx_size, scx_mtime_ns): return None
+        pos = XREF_HEADER.size
+        if raw[pos:pos + key_size] != key.encode(): return None
+        pos += key_size
+        arrays = list['array[int]']()
+        for length in (label_count, label_count, string_count + 1, ref_count, ref_count, label_count + 2, ref_count, ref_count):
+            arr = array('I')
+            arr.frombytes(raw[pos:pos + 4 * length])
+            if len(arr) != length: return None # 不完整的缓存直接重建
+            arrays.append(arr); pos += 4 * length
+        return cls(string_count, *arrays)
+
+    @classmethod
+    def cached(cls, scx_path: Path, scanner: XrefScanner):
+        # 索引缓存在SCX旁边，SCX的大小或修改时间变化、或扫描方式不同时重建
+        stat = scx_path.stat()
+        index_path = cls.path_for(scx_path)
+        if (xref := cls.read(index_path, stat.st_size, stat.st_mtime_ns, scanner.key)) is not None:
+            stats.count('scx.xref.cache_hits')
+            return xref
+        with LazySCXLayout.open(scx_path) as layout:
+            xref = cls.from_layout(layout, scanner)
+        xref.write(index_path, stat.st_size, stat.st_mtime_ns, scanner.key)
+        return xref
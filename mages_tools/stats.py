@@ -0,0 +1,80 @@
+from typing import Optional
+from dataclasses import dataclass, field
+from contextlib import nullcontext, contextmanager
+import threading
+import time
+
+# 使用处以stats.active的形式访问，未启用时钩子只多一次属性读取与比较
+
+@dataclass(slots=True)
+class Stats:
+    counters: dict[str, int] = field(default_factory=dict)
+    seconds: dict[str, float] = field(default_factory=dict) # 各阶段累计耗时
+    calls: dict[str, int] = field(default_factory=dict) # 各阶段进入次数
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_io(self, name: str, size: int):
+        with self.lock:
+            self.counters[f'{name}.calls'] = self.counters.get(f'{name}.calls', 0) + 1
+            self.counters[f'{name}.bytes'] = self.counters.get(f'{name}.bytes', 0) + size
+
+    def add_time(self, name: str, seconds: float):
+        with self.lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def to_json(self):
+        return {
+            'counters': dict(sorted(self.counters.items())),
+            'stages': {name: {'seconds': self.seconds[name], 'calls': self.calls[name]} for name in sorted(self.seconds)},
+        }
+
+    def summary(self):
+        lines = list[str]()
+        for name in sorted(self.seconds):
+            lines.append(f'{name:28} {self.seconds[name] * 1e3:12.2f} ms {self.calls[name]:10} calls')
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'{name:28} {value:15}')
+        return '\n'.join(lines)
+
+class Stage:
+    __slots__ = ('stats', 'name', 'start')
+
+    def __init__(self, stats: Stats, name: str):
+        self.stats = stats; self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.stats.add_time(self.name, time.perf_counter() - self.start)
+
+active: Optional[Stats] = None
+NULL_STAGE = nullcontext()
+
+def enable(stats: Optional[Stats] = None):
+    global active
+    active = Stats() if stats is None else stats
+    return active
+
+def disable():
+    global active
+    active = None
+
+@contextmanager
+def collect():
+    prev = active
+    try: yield enable()
+    finally:
+        if prev is None: disable()
+        else: enable(prev)
+
+def stage(name: str):
+    return NULL_STAGE if active is None else Stage(active, name)
+
+def count(name: str, value: int = 1):
+    if active is not None: active.add(name, value)
@@ -0,0 +1,22 @@
+import asyncio
+from mages_tools.aio import DEFAULT_RUNNER
+from mages_tools.mpk import Layout
+from mages_tools.mpk.aio import aunpack
+
+def test_default_runner_across_event_loops():
+    # 并发数以上的任务需要等待信号量，第二个事件循环不能用到绑定在第一个上的信号量
+    async def run_many():
+        return await asyncio.gather(*(DEFAULT_RUNNER.run(pow, i, 2) for i in range(DEFAULT_RUNNER.concurrency * 4)))
+    expect = [i * i for i in range(DEFAULT_RUNNER.concurrency * 4)]
+    assert asyncio.run(run_many()) == expect
+    assert asyncio.run(run_many()) == expect
+
+def test_aunpack_twice(tmp_path):
+    entries = {f'{i}.bin'.encode(): bytes([i]) * (i * 100) for i in range(20)}
+    src = tmp_path / 'a.mpk'
+    Layout(entries=entries).write(src)
+    for name in ('x', 'y'):
+        dst = tmp_path / name
+        dst.mkdir()
+        asyncio.run(aunpack(src, dst))
+        assert {path.name.encode(): path.read_bytes() for path in (dst / 'a').iterdir()} == entries
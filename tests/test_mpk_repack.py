@@ -0,0 +1,31 @@
+import os
+import tracemalloc
+import pytest
+from mages_tools.mpk import Layout, repack
+from mages_tools.mpk.compression import compress_all, compress_suffixes
+
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_repack_compressed_round_trip(tmp_path, jobs):
+    src = tmp_path / 'a'
+    src.mkdir()
+    expect = {f'{i:02d}.{"txt" if i % 2 else "bin"}'.encode(): b'abc' * (i * 500) for i in range(20)}
+    for name, data in expect.items(): (src / name.decode()).write_bytes(data)
+    repack(src, tmp_path, policy=compress_suffixes([b'.txt']), jobs=jobs)
+    layout = Layout.read(tmp_path / 'a.mpk')
+    assert layout.entries == expect
+    Layout(entries=expect).write(tmp_path / 'b.mpk', policy=compress_suffixes([b'.txt']))
+    assert (tmp_path / 'a.mpk').read_bytes() == (tmp_path / 'b.mpk').read_bytes()
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_repack_compresses_while_writing(tmp_path, jobs):
+    # 压缩结果不应全部留在内存中
+    src = tmp_path / 'a'
+    src.mkdir()
+    count, size = 40, 1 << 18
+    for i in range(count): (src / f'{i:02d}').write_bytes(os.urandom(size))
+    tracemalloc.start()
+    try:
+        repack(src, tmp_path, policy=compress_all(), jobs=jobs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally: tracemalloc.stop()
+    assert peak < count * size // 4
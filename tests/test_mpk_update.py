@@ -0,0 +1,63 @@
+import random
+from mages_tools.mpk import Layout, LazyLayout, update, compact
+
+def read_all(path):
+    with LazyLayout.open(path) as layout:
+        return {name: bytes(layout[name]) for name in layout}
+
+def test_update_empty_entry_after_append(tmp_path):
+    # 追加的记录与大小为0的记录位置相同时，不能把后者当作最后一条记录
+    path = tmp_path / 'a.mpk'
+    Layout(entries={b'a': b'A' * 100, b'z': b''}).write(path)
+    update(path, {b'a': b'X' * 3000})
+    update(path, {b'z': b'hello'})
+    assert read_all(path) == {b'a': b'X' * 3000, b'z': b'hello'}
+    assert Layout.read(path).entries == {b'a': b'X' * 3000, b'z': b'hello'}
+
+def test_update_empty_entries_between_payloads(tmp_path):
+    path = tmp_path / 'a.mpk'
+    Layout(entries={b'a': b'A' * 10, b'e1': b'', b'b': b'B' * 10, b'e2': b''}).write(path)
+    update(path, {b'e1': b'one', b'b': b'b' * 5000})
+    update(path, {b'e2': b'two', b'a': b'a' * 20})
+    assert read_all(path) == {b'a': b'a' * 20, b'e1': b'one', b'b': b'b' * 5000, b'e2': b'two'}
+
+def test_update_after_compact(tmp_path):
+    path = tmp_path / 'a.mpk'
+    rng = random.Random(0)
+    expect = {f'{i}'.encode(): rng.randbytes(rng.choice([0, 0, 10, 3000])) for i in range(12)}
+    Layout(entries=expect).write(path)
+    for round_idx in range(20):
+        replaces = {name: rng.randbytes(rng.choice([0, 5, 2048, 5000])) for name in rng.sample(sorted(expect), 3)}
+        update(path, replaces)
+        expect.update(replaces)
+        if round_idx % 5 == 4:
+            compact(path)
+        assert read_all(path) == expect
+        assert Layout.read(path).entries == expect
+
+def test_changed_files_skips_unchanged(tmp_path):
+    from mages_tools.mpk import unpack
+    from mages_tools.mpk.utils import changed_files
+    path = tmp_path / 'a.mpk'
+    Layout(entries={b'a': b'A' * 100, b'b': b'B' * 3000, b'e': b''}).write(path)
+    out = tmp_path / 'out'
+    out.mkdir()
+    unpack(path, out, manifest=True)
+    src = out / 'a'
+    assert changed_files(src, path) == {}
+    assert changed_files(src, path, manifest=True) == {}
+    (src / 'b').write_bytes(b'C' * 3000) # 大小相同、内容不同
+    assert set(changed_files(src, path)) == {b'b'}
+    assert set(changed_files(src, path, manifest=True)) == {b'b'}
+    size = path.stat().st_size
+    update(path, changed_files(src, path))
+    assert changed_files(src, path) == {}
+    update(path, changed_files(src, path))
+    assert path.stat().st_size == size
+
+def test_update_tail_keeps_trailing_empty_entry(tmp_path):
+    path = tmp_path / 'a.mpk'
+    Layout(entries={b'a': b'A' * 100, b'b': b'B' * 3000, b'e': b''}).write(path)
+    update(path, {b'b': b'b' * 10})
+    assert read_all(path) == {b'a': b'A' * 100, b'b': b'b' * 10, b'e': b''}
+    assert Layout.read(path).entries == {b'a': b'A' * 100, b'b': b'b' * 10, b'e': b''}
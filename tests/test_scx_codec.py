@@ -0,0 +1,26 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from mages_tools.scx.codec import SCXCodec, DEFAULT_CODEC
+
+def test_derived_codec_first_use_from_many_threads():
+    # '％'在默认字符集中出现两次，替换它时无法沿用基础codec的表，要生成完整的表
+    for replaces in ([('A', 'Ä')], [('％', 'Ä')]):
+        for _ in range(20):
+            derived = SCXCodec.base_on(DEFAULT_CODEC, replaces)
+            fresh = SCXCodec(dict(derived.charset))
+            barrier = threading.Barrier(8)
+            def use(_):
+                barrier.wait()
+                return derived.encode('ÄB').tolist(), derived.decode(fresh.encode('ÄB'))
+            with ThreadPoolExecutor(8) as pool:
+                results = list(pool.map(use, range(8)))
+            assert results == [(fresh.encode('ÄB').tolist(), 'ÄB')] * 8
+
+def test_derived_codec_matches_fresh_build():
+    derived = SCXCodec.base_on(SCXCodec.base_on(DEFAULT_CODEC, [('A', 'B'), ('B', 'A')]), [('C', 'Ω')])
+    fresh = SCXCodec(dict(derived.charset))
+    text = 'ABΩ ０'
+    assert derived.encode(text).tolist() == fresh.encode(text).tolist()
+    assert derived.encode_text(text) == fresh.encode_text(text)
+    assert derived.decode(fresh.encode(text)) == text
+    assert derived._tables is None # 沿用基础codec的表
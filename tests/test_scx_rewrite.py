@@ -0,0 +1,47 @@
+import random
+from pathlib import Path
+from array import array
+from mages_tools.scx import Layout, LazyLayout
+from mages_tools.scx.tokenizer import tokenize_from_buffer
+from mages_tools.scx.bulk import export_strings, import_strings
+
+def make_layout(count: int, seed: int = 0):
+    # 字符串数据不按序号排列
+    rng = random.Random(seed)
+    order = list(range(count))
+    rng.shuffle(order)
+    strings = [bytes([0x80, 0x01 + i % 60, 0x80, 0x02]) * (1 + i % 3) + b'\xff' for i in range(count)]
+    return Layout(
+        entry_label=20,
+        labels=array('I', [20, 20]),
+        codes_raw=b'\x00' * 8,
+        return_addrs=array('I', [0]),
+        strings_raw=strings,
+        string_order=order,
+    )
+
+def test_rewrite_keeps_string_order(tmp_path):
+    path = tmp_path / 'a.scx'
+    make_layout(30).write(path, follow_given_order=True)
+    layout = Layout.read(path)
+    order = list(layout.string_order)
+    assert order != list(range(30))
+    layout.rewrite({3: list(tokenize_from_buffer(layout.strings_raw[5][:-1])), 7: '0'})
+    layout.write(tmp_path / 'b.scx', follow_given_order=True)
+    result = Layout.read(tmp_path / 'b.scx')
+    assert result.string_order == order
+    assert result.strings_raw == layout.strings_raw
+    with LazyLayout.open(path) as lazy:
+        lazy.rewrite({3: list(tokenize_from_buffer(layout.strings_raw[5][:-1])), 7: '0'})
+        lazy.write(tmp_path / 'c.scx')
+    assert (tmp_path / 'c.scx').read_bytes() == (tmp_path / 'b.scx').read_bytes()
+
+def test_noop_import_is_byte_identical(tmp_path):
+    src = tmp_path / 'src'
+    out = tmp_path / 'out'
+    src.mkdir()
+    for seed in range(3): make_layout(25, seed).write(src / f'{seed}.scx', follow_given_order=True)
+    export_strings(src, tmp_path / 'strings.jsonl', jobs=1)
+    import_strings(src, tmp_path / 'strings.jsonl', out, jobs=1)
+    for path in sorted(src.iterdir()):
+        assert (out / path.name).read_bytes() == path.read_bytes()